@@ -80,7 +80,8 @@ echo "-------------------------------------------------------------------------"
 echo " Installing additional Python packages"
 echo "-------------------------------------------------------------------------"
 
-echo "y" | conda install -c conda-forge rasterio psycopg2 postgis aiohttp
+echo "y" | conda install -c conda-forge rasterio psycopg2 postgis aiohttp shapely
+pip3 install onnx onnxruntime-gpu  # for exported (ONNX) models - see 05a_export_model.py
 
 echo "-------------------------------------------------------------------------"
 echo " Copy data from S3"
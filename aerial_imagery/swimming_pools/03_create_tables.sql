@@ -44,6 +44,18 @@ ALTER TABLE data_science.pool_training_images ADD CONSTRAINT pool_training_image
 CREATE INDEX pool_training_images_geom_idx ON data_science.pool_training_images USING gist (geom);
 ALTER TABLE data_science.pool_training_images CLUSTER ON pool_training_images_geom_idx;
 
+-- manifest of imported training files (used to only import new or changed images)
+drop table if exists data_science.pool_training_files;
+create table data_science.pool_training_files (
+    file_path text NOT NULL,
+    modified bigint NOT NULL,
+    file_size bigint NOT NULL,
+    label_hash text NULL
+);
+alter table data_science.pool_training_files owner to "ec2-user";
+
+ALTER TABLE data_science.pool_training_files ADD CONSTRAINT pool_training_files_pkey PRIMARY KEY (file_path);
+
 
 drop table if exists data_science.pool_labels;
 create table data_science.pool_labels (
@@ -81,3 +93,35 @@ alter table data_science.pool_images owner to "ec2-user";
 ALTER TABLE data_science.pool_images ADD CONSTRAINT pool_images_pkey PRIMARY KEY (file_path);
 CREATE INDEX pool_images_geom_idx ON data_science.pool_images USING gist (geom);
 ALTER TABLE data_science.pool_images CLUSTER ON pool_images_geom_idx;
+
+
+-- run ledger: the processing state of each image in a pool detection run (pending, downloaded, inferred or failed)
+drop table if exists data_science.pool_tiles;
+create table data_science.pool_tiles (
+    file_path text NOT NULL,
+    latitude double precision NOT NULL,
+    longitude double precision NOT NULL,
+    state text NOT NULL,
+    batch_id integer,
+    updated timestamp with time zone NOT NULL DEFAULT now()
+);
+alter table data_science.pool_tiles owner to "ec2-user";
+
+ALTER TABLE data_science.pool_tiles ADD CONSTRAINT pool_tiles_pkey PRIMARY KEY (file_path);
+CREATE INDEX pool_tiles_state_idx ON data_science.pool_tiles USING btree (state);
+CREATE INDEX pool_tiles_batch_id_idx ON data_science.pool_tiles USING btree (batch_id);
+
+
+-- work queue for distributed pool detection runs: batches of images claimed by workers (pending, claimed or done)
+drop table if exists data_science.pool_batches;
+create table data_science.pool_batches (
+    batch_id integer NOT NULL,
+    state text NOT NULL,
+    worker text,
+    lease_expires timestamp with time zone,
+    attempts integer NOT NULL DEFAULT 0
+);
+alter table data_science.pool_batches owner to "ec2-user";
+
+ALTER TABLE data_science.pool_batches ADD CONSTRAINT pool_batches_pkey PRIMARY KEY (batch_id);
+CREATE INDEX pool_batches_state_idx ON data_science.pool_batches USING btree (state);
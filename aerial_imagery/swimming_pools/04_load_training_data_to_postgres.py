@@ -1,22 +1,37 @@
 
 import glob
+import hashlib
+import io
 import multiprocessing
+import multiprocessing.util
+import numpy
 import os
 import platform
 import psycopg2
 import psycopg2.extras
 import rasterio
+import threading
 
 from datetime import datetime
 from psycopg2 import pool
-from psycopg2.extensions import AsIs
 
 # how many parallel processes to run
-cpu_count = int(multiprocessing.cpu_count() * 0.8)
+cpu_count = max(int(multiprocessing.cpu_count() * 0.8), 1)
+
+# how many rows each process buffers before copying them into Postgres in bulk (across all output tables)
+postgres_flush_size = 10000
+
+# how many images to send to each process at a time (cuts the overhead of passing out lots of small jobs)
+image_chunk_size = 100
+
+# only import images that are new or have changed (image or label file) since the last import, and remove images that
+# no longer exist. Set to False to clear out the tables & import everything
+incremental_import = True
 
 # output tables
 label_table = "data_science.pool_training_labels"
 image_table = "data_science.pool_training_images"
+file_table = "data_science.pool_training_files"  # manifest of imported files (used for incremental imports)
 
 # reference tables
 gnaf_table = "data_science.address_principals_nsw"
@@ -36,35 +51,85 @@ else:
     search_path = f"{os.path.expanduser('~')}/datasets/pool/images/train2017/*.tif"
     label_path = f"{os.path.expanduser('~')}/datasets/pool/labels/train2017"
 
-# create postgres connection pool
-pg_pool = psycopg2.pool.SimpleConnectionPool(1, cpu_count, pg_connect_string)
+# postgres connection pool - each process creates its own (connections can't be shared by forked processes)
+pg_pool = None
+
+# rows waiting to be copied into Postgres, by table
+row_buffers = dict()
+row_buffer_lock = threading.Lock()
+
+# extended well known binary (EWKB) structures for points & polygons (used to create geometries for the database)
+ewkb_point_dtype = numpy.dtype([("byte_order", "u1"), ("geometry_type", "<u4"), ("srid", "<u4"),
+                                ("x", "<f8"), ("y", "<f8")])
+ewkb_polygon_dtype = numpy.dtype([("byte_order", "u1"), ("geometry_type", "<u4"), ("srid", "<u4"),
+                                  ("ring_count", "<u4"), ("point_count", "<u4"), ("coords", "<f8", (10,))])
 
 
 def main():
+    global pg_pool
+
     start_time = datetime.now()
 
     print(f"START : swimming pool image & label import : {start_time}")
 
+    # create postgres connection pool
+    pg_pool = psycopg2.pool.SimpleConnectionPool(1, 2, pg_connect_string)
+
     # get postgres connection from pool
     pg_conn = pg_pool.getconn()
     pg_conn.autocommit = True
     pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-    # clean out target tables
-    pg_cur.execute(f"truncate table {label_table}")
-    pg_cur.execute(f"truncate table {image_table}")
+    if incremental_import:
+        # get the files imported last time
+        pg_cur.execute(f"select file_path, modified, file_size, label_hash from {file_table}")
+        imported_files = {row[0]: [row[0], row[1], row[2], row[3]] for row in pg_cur.fetchall()}
+    else:
+        # clean out target tables
+        pg_cur.execute(f"truncate table {label_table}")
+        pg_cur.execute(f"truncate table {image_table}")
+        pg_cur.execute(f"truncate table {file_table}")
 
     # get list of image paths and process them using multiprocessing
-    file_list = list()
-    image_count = 0
-    for file_name in glob.glob(search_path):
-        file_list.append(file_name)
-        image_count += 1
+    file_list = glob.glob(search_path)
+
+    # close this process's postgres connections before forking - the import processes open their own
+    pg_cur.close()
+    pg_pool.putconn(pg_conn)
+    pg_pool.closeall()
+
+    mp_pool = multiprocessing.Pool(cpu_count, initializer=init_process)
+
+    # reconnect to postgres
+    pg_pool = psycopg2.pool.SimpleConnectionPool(1, 2, pg_connect_string)
+    pg_conn = pg_pool.getconn()
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    if incremental_import:
+        # compare the files with the last import (in parallel - label files are read to get their hashes)
+        file_infos = mp_pool.map(get_file_info, file_list, chunksize=image_chunk_size)
+
+        new_file_list = [file_info[0] for file_info in file_infos if file_info[0] not in imported_files]
+        changed_file_list = [file_info[0] for file_info in file_infos
+                             if file_info[0] in imported_files and file_info != imported_files[file_info[0]]]
+        removed_file_list = list(set(imported_files.keys()).difference(file_list))
+
+        print(f"\t - {len(file_list)} images found : {len(new_file_list)} new : {len(changed_file_list)} changed : "
+              f"{len(removed_file_list)} removed")
+
+        # remove the changed & removed images (changed images are imported again). New images are removed too, in case
+        # they were imported before there was a manifest
+        file_list = new_file_list + changed_file_list
+
+        for table_name in [label_table, image_table, file_table]:
+            pg_cur.execute(f"delete from {table_name} where file_path = any(%s)", (file_list + removed_file_list,))
+
+    image_count = len(file_list)
 
     print(f"\t - {image_count} images to import")
 
-    mp_pool = multiprocessing.Pool(cpu_count)
-    mp_results = mp_pool.imap_unordered(import_label_to_postgres, file_list)
+    mp_results = mp_pool.imap_unordered(import_label_to_postgres, file_list, chunksize=image_chunk_size)
     mp_pool.close()
     mp_pool.join()
 
@@ -85,6 +150,10 @@ def main():
     # output results to screen
     print(f"\t - {total_label_count} labels imported")
 
+    # tag all labels with their land parcel and address IDs in one pass
+    tagged_label_count = tag_labels_with_parcel_and_address_ids()
+    print(f"\t - {tagged_label_count} labels tagged with parcel & address IDs")
+
     # get counts of missing parcels and addresses
     pg_cur.execute(f"select count(*) from {label_table} where legal_parcel_id is NULL")
     row = pg_cur.fetchone()
@@ -106,17 +175,27 @@ def main():
     print(f"FINISHED : swimming pool image & label import : {datetime.now() - start_time}")
 
 
-def get_image(file_path):
+def init_process():
+    global pg_pool
 
-    output = dict()
+    # create this process's postgres connection pool (only one connection is needed - rows are copied in bulk)
+    pg_pool = psycopg2.pool.SimpleConnectionPool(1, 1, pg_connect_string)
 
-    output["image"] = rasterio.open(file_path)
+    # stop GDAL listing the image's directory every time an image is opened (slow with tens of thousands of images)
+    os.environ["GDAL_DISABLE_READDIR_ON_OPEN"] = "EMPTY_DIR"
 
-    output["bands"] = output["image"].count
-    output["width"] = output["image"].width
-    output["height"] = output["image"].height
+    # copy each process's remaining buffered rows into Postgres when it exits
+    multiprocessing.util.Finalize(None, flush_rows, exitpriority=10)
+
+
+def get_image(file_path):
+
+    output = dict()
 
-    bounds = output["image"].bounds
+    # only the image's header is needed (pixels aren't read)
+    with rasterio.open(file_path) as image:
+        output["bands"] = image.count
+        bounds = image.bounds
 
     output["x_min"] = bounds.left
     output["y_min"] = bounds.bottom
@@ -132,27 +211,80 @@ def get_image(file_path):
     output["x_centre"] = (bounds.right + bounds.left) / 2.0
     output["y_centre"] = (bounds.bottom + bounds.top) / 2.0
 
+    output["label_file"] = get_label_file_path(file_path)
+    # print(output["label_file"])
+
+    return output
+
+
+def get_label_file_path(file_path):
     label_file_path = os.path.split(os.path.abspath(file_path))
 
     # todo: get rid of lazy condition to allow for testing locally and remotely
     if label_path is None:
-        output["label_file"] = os.path.join(label_file_path[0] + "_labels", label_file_path[1].replace(".tif", ".txt"))
+        return os.path.join(label_file_path[0] + "_labels", label_file_path[1].replace(".tif", ".txt"))
     else:
-        output["label_file"] = os.path.join(label_path, label_file_path[1].replace(".tif", ".txt"))
-    # print(output["label_file"])
+        return os.path.join(label_path, label_file_path[1].replace(".tif", ".txt"))
+
+
+def read_label_file(label_file_path):
+    # get the contents of a label file (None if the image has no label file)
+    if not os.path.isfile(label_file_path):
+        return None
+
+    with open(label_file_path, "rb") as label_file:
+        return label_file.read()
 
-    return output
 
+def get_file_info(image_path, label_bytes=None):
+    # get an image's modified time & size and a hash of its label file - if any of these change the image is reimported
+    # (the label file's contents are hashed as label files can be rewritten without changing)
+    if label_bytes is None:
+        label_bytes = read_label_file(get_label_file_path(image_path))
 
-def make_wkt_point(x_centre, y_centre):
-    return f"POINT({x_centre} {y_centre})"
+    label_hash = None
+    if label_bytes is not None:
+        label_hash = hashlib.md5(label_bytes).hexdigest()
 
+    file_stat = os.stat(image_path)
 
-def make_wkt_polygon(x_min, y_min, x_max, y_max):
-    return f"POLYGON(({x_min} {y_min}, {x_min} {y_max}, {x_max} {y_max}, {x_max} {y_min}, {x_min} {y_min}))"
+    return [image_path, file_stat.st_mtime_ns, file_stat.st_size, label_hash]
 
 
-def convert_label_to_polygon(image, label):
+def make_ewkb_points(x_centres, y_centres):
+    # create hex encoded extended well known binary (EWKB) points (SRID 4283) - Postgres loads these without parsing text
+    ewkb_points = numpy.empty(len(x_centres), dtype=ewkb_point_dtype)
+    ewkb_points["byte_order"] = 1  # little endian
+    ewkb_points["geometry_type"] = 0x20000001  # point with an SRID
+    ewkb_points["srid"] = 4283
+    ewkb_points["x"] = x_centres
+    ewkb_points["y"] = y_centres
+
+    return encode_ewkb(ewkb_points)
+
+
+def make_ewkb_polygons(x_mins, y_mins, x_maxs, y_maxs):
+    # create hex encoded extended well known binary (EWKB) polygons (SRID 4283) from bounding boxes
+    ewkb_polygons = numpy.empty(len(x_mins), dtype=ewkb_polygon_dtype)
+    ewkb_polygons["byte_order"] = 1  # little endian
+    ewkb_polygons["geometry_type"] = 0x20000003  # polygon with an SRID
+    ewkb_polygons["srid"] = 4283
+    ewkb_polygons["ring_count"] = 1
+    ewkb_polygons["point_count"] = 5
+    ewkb_polygons["coords"] = numpy.stack([x_mins, y_mins, x_mins, y_maxs, x_maxs, y_maxs, x_maxs, y_mins,
+                                           x_mins, y_mins], axis=1)
+
+    return encode_ewkb(ewkb_polygons)
+
+
+def encode_ewkb(ewkb_array):
+    # hex encode an array of fixed size EWKB geometries in one go
+    hex_bytes = ewkb_array.tobytes().hex().encode("ascii")
+
+    return numpy.frombuffer(hex_bytes, dtype=f"S{ewkb_array.dtype.itemsize * 2}").astype(str).tolist()
+
+
+def convert_labels_to_rows(image_path, image, labels):
     # format of YOLO label files provided is:
     #   - class (always 0 as there's only one label in this training data: "pool")
     #   - centroid percentage distance from leftmost pixel
@@ -160,32 +292,26 @@ def convert_label_to_polygon(image, label):
     #   - percentage width of bounding box
     #   - percentage height of bounding box
 
-    label_x_centre = float(label[1])
-    label_y_centre = float(label[2])
-    label_x_offset = float(label[3])
-    label_y_offset = float(label[4])
-
-    # get lat/long bounding box
-    x_min = image["x_min"] + image["width"] * (label_x_centre - label_x_offset / 2.0)
-    y_min = image["y_max"] - image["height"] * (label_y_centre + label_y_offset / 2.0)
-    x_max = image["x_min"] + image["width"] * (label_x_centre + label_x_offset / 2.0)
-    y_max = image["y_max"] - image["height"] * (label_y_centre - label_y_offset / 2.0)
+    # get lat/long bounding boxes for all of the image's labels at once
+    x_mins = image["x_min"] + image["width"] * (labels[:, 1] - labels[:, 3] / 2.0)
+    y_mins = image["y_max"] - image["height"] * (labels[:, 2] + labels[:, 4] / 2.0)
+    x_maxs = image["x_min"] + image["width"] * (labels[:, 1] + labels[:, 3] / 2.0)
+    y_maxs = image["y_max"] - image["height"] * (labels[:, 2] - labels[:, 4] / 2.0)
 
-    # get lat/long centroid
-    x_centre = (x_min + x_max) / 2.0
-    y_centre = (y_min + y_max) / 2.0
+    # get lat/long centroids
+    x_centres = (x_mins + x_maxs) / 2.0
+    y_centres = (y_mins + y_maxs) / 2.0
 
-    # create well known text (WKT) geometries
-    point = make_wkt_point(x_centre, y_centre)
-    polygon = make_wkt_polygon(x_min, y_min, x_max, y_max)
+    # create well known binary (EWKB) geometries
+    points = make_ewkb_points(x_centres, y_centres)
+    polygons = make_ewkb_polygons(x_mins, y_mins, x_maxs, y_maxs)
 
-    return y_centre, x_centre, point, polygon
+    return [[image_path, y_centre, x_centre, point, polygon]
+            for y_centre, x_centre, point, polygon in zip(y_centres.tolist(), x_centres.tolist(), points, polygons)]
 
 
-def get_parcel_and_address_ids(latitude, longitude):
-    legal_parcel_id = None
-    gnaf_pid = None
-    address = None
+def tag_labels_with_parcel_and_address_ids():
+    # tag all untagged labels with their land parcel and address IDs in one pass, using a set-based spatial join
 
     # get postgres connection from pool
     pg_conn = pg_pool.getconn()
@@ -193,48 +319,110 @@ def get_parcel_and_address_ids(latitude, longitude):
     pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     # get legal parcel ID and address ID using spatial join (joining on legal parcel ID is flaky due to GNAF's approach)
-    sql = f"""select cad.jurisdiction_id, 
-                     gnaf.gnaf_pid, 
-                     concat(gnaf.address, ', ', gnaf.locality_name, ' ', gnaf.state, ' ', gnaf.postcode) as address
-              from {cad_table} as cad
-              inner join {gnaf_table} as gnaf on st_intersects(gnaf.geom, cad.geom)
-              where st_intersects(st_setsrid(st_makepoint({longitude}, {latitude}), 4283), cad.geom)"""
-    pg_cur.execute(sql)
-
     # TODO: import all the results. Can return multiple addresses due to strata titles & the specifics of land titling
-    row = pg_cur.fetchone()
-
-    if row is not None:
-        legal_parcel_id = row[0]
-        gnaf_pid = row[1]
-        address = row[2]
+    sql = f"""with tags as (
+                  select lab.ctid as label_ctid,
+                         ref.jurisdiction_id,
+                         ref.gnaf_pid,
+                         ref.address
+                  from {label_table} as lab
+                  cross join lateral (
+                      select cad.jurisdiction_id,
+                             gnaf.gnaf_pid,
+                             concat(gnaf.address, ', ', gnaf.locality_name, ' ', gnaf.state, ' ', gnaf.postcode) as address
+                      from {cad_table} as cad
+                      inner join {gnaf_table} as gnaf on st_intersects(gnaf.geom, cad.geom)
+                      where st_intersects(lab.point_geom, cad.geom)
+                      limit 1
+                  ) as ref
+                  where lab.legal_parcel_id is null
+              )
+              update {label_table} as lab
+                  set legal_parcel_id = tags.jurisdiction_id,
+                      gnaf_pid = tags.gnaf_pid,
+                      address = tags.address
+              from tags
+              where lab.ctid = tags.label_ctid"""
+    pg_cur.execute(sql)
+    tagged_label_count = pg_cur.rowcount
 
     # clean up postgres connection
     pg_cur.close()
     pg_pool.putconn(pg_conn)
 
-    # print(f"{legal_parcel_id} : {gnaf_pid}")
-
-    return legal_parcel_id, gnaf_pid, address
+    return tagged_label_count
 
 
 def insert_row(table_name, row):
+    # buffer the row; rows are copied into Postgres in bulk once the flush size is reached
+    # (dict keys must match existing table structure)
+    insert_rows(table_name, list(row.keys()), [list(row.values())])
+
+
+def insert_rows(table_name, columns, rows):
+    # buffer a list of rows (lists of values in the same order as the column names)
+    with row_buffer_lock:
+        # the first rows buffered for a table set the column order
+        if table_name not in row_buffers:
+            row_buffers[table_name] = {"columns": columns, "rows": list()}
+
+        row_buffer = row_buffers[table_name]
+        if columns == row_buffer["columns"]:
+            row_buffer["rows"].extend(rows)
+        else:
+            for row in rows:
+                row_dict = dict(zip(columns, row))
+                row_buffer["rows"].append([row_dict.get(column) for column in row_buffer["columns"]])
+
+        buffered_row_count = sum([len(row_buffer["rows"]) for row_buffer in row_buffers.values()])
+
+    if buffered_row_count >= postgres_flush_size:
+        flush_rows()
+
+
+def flush_rows():
+    global row_buffers
+
+    # swap out the buffers so new rows can be buffered while these ones are copied
+    with row_buffer_lock:
+        table_buffers = row_buffers
+        row_buffers = dict()
+
+    if len(table_buffers) == 0:
+        return
+
     # get postgres connection from pool
     pg_conn = pg_pool.getconn()
-    pg_conn.autocommit = True
-    pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    pg_conn.autocommit = False
+    pg_cur = pg_conn.cursor()
 
-    # get column names & values (dict keys must match existing table structure)
-    columns = list(row.keys())
-    values = [row[column] for column in columns]
+    # copy all buffered rows into their tables in a single transaction
+    try:
+        for table_name, row_buffer in table_buffers.items():
+            copy_file = io.StringIO()
+            for values in row_buffer["rows"]:
+                copy_file.write("\t".join([format_copy_value(value) for value in values]) + "\n")
+            copy_file.seek(0)
 
-    insert_statement = f"INSERT INTO {table_name} (%s) VALUES %s"
-    sql = pg_cur.mogrify(insert_statement, (AsIs(','.join(columns)), tuple(values))).decode("utf-8")
-    pg_cur.execute(sql)
+            pg_cur.copy_expert(f"COPY {table_name} ({','.join(row_buffer['columns'])}) FROM STDIN", copy_file)
+
+        pg_conn.commit()
+    except Exception:
+        pg_conn.rollback()
+        raise
+    finally:
+        # clean up postgres connection
+        pg_cur.close()
+        pg_conn.autocommit = True
+        pg_pool.putconn(pg_conn)
 
-    # clean up postgres connection
-    pg_cur.close()
-    pg_pool.putconn(pg_conn)
+
+def format_copy_value(value):
+    # format a python value as a field in Postgres' COPY text format
+    if value is None:
+        return "\\N"
+
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
 
 
 def import_label_to_postgres(image_path):
@@ -244,26 +432,19 @@ def import_label_to_postgres(image_path):
     # convert labels to polygons (if label file exists. Image could have no labelled features)
     label_count = 0
 
-    if os.path.isfile(image["label_file"]):
-        with open(image["label_file"], "r") as file:
-
-            # insert row for each line in file (TODO: insert in one block of sql statements for performance lift)
-            for line in file:
-                label_row = dict()
-                label_row["file_path"] = image_path
+    label_bytes = read_label_file(image["label_file"])
 
-                # get label centre and polygon
-                label_row["latitude"], label_row["longitude"], label_row["point_geom"], label_row["geom"] = \
-                    convert_label_to_polygon(image, line.split(" "))
+    if label_bytes is not None:
+        # read all labels in the file at once (5 numbers per label - one label per line)
+        labels = numpy.array(label_bytes.split(), dtype=numpy.float64).reshape(-1, 5)
 
-                # get legal parcel identifier & address ID (gnaf_pid)
-                label_row["legal_parcel_id"], label_row["gnaf_pid"], label_row["address"] = \
-                    get_parcel_and_address_ids(label_row["latitude"], label_row["longitude"])
+        if labels.size > 0:
+            # get label centres and polygons & buffer them for bulk insert into postgres
+            # note: legal parcel identifier & address ID (gnaf_pid) are tagged in one pass after import
+            label_rows = convert_labels_to_rows(image_path, image, labels)
+            insert_rows(label_table, ["file_path", "latitude", "longitude", "point_geom", "geom"], label_rows)
 
-                # insert into postgres
-                insert_row(label_table,  label_row)
-
-                label_count += 1
+            label_count = len(label_rows)
 
     # import image bounds as polygons for reference
     image_row = dict()
@@ -271,8 +452,12 @@ def import_label_to_postgres(image_path):
     image_row["label_count"] = label_count
     image_row["width"] = image["width"]
     image_row["height"] = image["height"]
-    image_row["geom"] = make_wkt_polygon(image["x_min"], image["y_min"], image["x_max"], image["y_max"])
-    insert_row(image_table,  image_row)
+    image_row["geom"] = make_ewkb_polygons([image["x_min"]], [image["y_min"]], [image["x_max"]], [image["y_max"]])[0]
+    insert_row(image_table, image_row)
+
+    # record the image's file info in the manifest (copied into Postgres with the image, so they can't get out of step)
+    file_info = get_file_info(image_path, label_bytes)
+    insert_rows(file_table, ["file_path", "modified", "file_size", "label_hash"], [file_info])
 
     return label_count
 
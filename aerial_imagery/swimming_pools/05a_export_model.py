@@ -0,0 +1,55 @@
+
+import importlib
+import os
+import sys
+
+from datetime import datetime
+
+# the pool detection script - for the YOLOv5 & trained model paths
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, script_dir)
+detector = importlib.import_module("06_detect_pools")
+
+# formats to export the trained model to (see inference_backend in 06_detect_pools.py)
+export_formats = ["torchscript", "onnx"]
+
+# also create a dynamically quantized (int8 weights) copy of the ONNX model for CPUs (needs onnxruntime)
+quantize_onnx_model = True
+
+
+def main():
+    start_time = datetime.now()
+
+    print(f"START : export pool detection model : {start_time}")
+
+    # YOLOv5's export code
+    sys.path.insert(0, detector.yolo_home)
+    import export
+
+    # export the trained model with a variable batch size (the detection script changes the batch size as it runs)
+    # note: TorchScript models are traced with a batch of 1; but run with any batch size
+    export.run(weights=detector.model_path, include=export_formats, imgsz=(detector.image_height, detector.image_width),
+               device="cpu", dynamic=True)
+
+    for export_format in export_formats:
+        detector.inference_backend = export_format
+        detector.inference_precision = "fp32"
+        print(f"\t - {export_format} model exported to {detector.get_exported_model_path()}")
+
+    if quantize_onnx_model and "onnx" in export_formats:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        detector.inference_backend = "onnx"
+        onnx_model_path = detector.get_exported_model_path()
+        detector.inference_precision = "int8"
+        int8_model_path = detector.get_exported_model_path()
+
+        # unsigned int8 weights - ONNX Runtime's CPU provider doesn't support signed int8 weights for convolutions
+        quantize_dynamic(onnx_model_path, int8_model_path, weight_type=QuantType.QUInt8)
+        print(f"\t - int8 ONNX model saved to {int8_model_path}")
+
+    print(f"FINISHED : export pool detection model : {datetime.now() - start_time}")
+
+
+if __name__ == "__main__":
+    main()
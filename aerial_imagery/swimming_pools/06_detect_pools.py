@@ -8,20 +8,39 @@
 -----------------------------------------------------------------------------------------------------------------"""
 
 import aiohttp
+import argparse
 import asyncio
+import atexit
+import bisect
+import collections
+import glob
+import hashlib
 import io
+import itertools
+import json
 import logging.config
 import math
+import numpy
 import os
 import platform
 import psycopg2
 import psycopg2.extras
+import queue
+import random
+import rasterio
+import rasterio.enums
+import rasterio.windows
+import resource
+import shapely
+import threading
+import time
 import torch
+import torchvision.io
+import torchvision.ops
 
 from datetime import datetime
 from PIL import Image
 from psycopg2 import pool
-from psycopg2.extensions import AsIs
 
 gnaf_table = None
 cad_table = None
@@ -54,6 +73,8 @@ use_reference_data = False
 # output tables
 label_table = "data_science.pool_labels"
 image_table = "data_science.pool_images"
+tile_table = "data_science.pool_tiles"  # run ledger: the processing state of each image (used to resume failed runs)
+batch_table = "data_science.pool_batches"  # work queue of image batches for distributed runs (--seed & --worker)
 
 if use_reference_data:
     # reference tables
@@ -83,6 +104,73 @@ else:
     yolo_home = f"{os.path.expanduser('~')}/yolov5"
     model_path = f"{os.path.expanduser('~')}/yolov5/runs/train/exp/weights/best.pt"
 
+# devices to run the model on. One process is run per device, each with its own copy of the model
+# (None = auto-detect: all CUDA GPUs, or the CPU if there are none). e.g. ["cpu", "cpu"] tests multi-GPU mode on a CPU
+inference_devices = None
+
+# CPU only machines: the number of processes to run the model in & the number of threads each process uses
+# processes x threads should match the number of CPU cores (None = auto-tune both using a short calibration run)
+cpu_process_count = None
+cpu_thread_count = None
+
+# how to run the model (export the trained model first using 05a_export_model.py if not using "pytorch"):
+#   - "pytorch": the trained YOLOv5 model (best.pt) via PyTorch Hub (needs a copy of the YOLOv5 code)
+#   - "torchscript": the TorchScript export of the model (best.torchscript)
+#   - "onnx": the ONNX export of the model (best.onnx), run by ONNX Runtime (usually the fastest on CPUs)
+inference_backend = "pytorch"
+
+# model precision: "fp32"; "fp16" (GPUs only, not with ONNX); or "int8" (ONNX on CPUs only - dynamically quantized
+# weights, best_int8.onnx). fp16 & int8 are faster but can lose some accuracy -
+# use testing/05_compare_inference_backends.py to compare them
+inference_precision = "fp32"
+
+# GeoJSON or WKT file of a boundary to create the grid of images in (lat/long coords). Only images touching the boundary
+# are processed; and the grid is calculated instead of read from the grid table (if using reference data)
+# e.g. the Sydney boundary: psql -Atc "select st_asgeojson(geom) from census_2016_bdys.ucl_2016_aust
+#                                      where ucl_name16 = 'Sydney'" > sydney.geojson
+# (None = use the min/max coords above, or the grid table if using reference data)
+clip_boundary_path = None
+
+# order to process images read from the database (the grid table, or the run ledger when resuming) in:
+#   - None: the order Postgres returns them in
+#   - "geohash": along a Z-order curve (by geohash)
+#   - "hilbert": along a Hilbert curve (how PostGIS sorts geometries)
+# both process nearby images together (better tile cache & Postgres cache hit rates)
+grid_order = None
+
+# fraction of each image that overlaps its neighbours (e.g. 0.1 = 64 pixels). Pools cut in half by the edge of one
+# image are whole in the next; and pools found in more than one image are merged into one label before they're saved
+# (0.0 = no overlap). Not used with the grid table (its images are a fixed distance apart)
+tile_overlap = 0.0
+
+# where to get images from:
+#   - "wms": download them from the NSW DCS Web Map Service (WMS)
+#   - "geotiff": read them from local GeoTIFFs or Cloud Optimised GeoTIFFs (COGs) (fast & works offline)
+#   - "tiles": read them from a directory of image files (named by get_image_file_path(), e.g. image_-33.8672_151.1331.jpg)
+imagery_source = "wms"
+
+# GeoTIFF/COG file to read images from; or a glob pattern for a mosaic of files, e.g. "/data/imagery/*.tif"
+# (must be RGB, 8 bit & in lat/long coords (e.g. EPSG:4283) - use gdalwarp to reproject them first if they're not)
+geotiff_path = f"{os.path.expanduser('~')}/tmp/image-classification/imagery/*.tif"
+
+# directory of image files to read images from
+tile_dir = f"{os.path.expanduser('~')}/tmp/image-classification/tiles"
+
+# local cache of downloaded images - re-running over the same area reads images from disk instead of the WMS
+# (set tile_cache_dir to None to turn off)
+tile_cache_dir = f"{os.path.expanduser('~')}/tmp/image-classification/tile-cache"
+tile_cache_max_gb = 20  # least recently used images are removed when the cache gets bigger than this
+tile_cache_trim_gb = 1  # the cache is also trimmed during a run, each time a process has written this much to it
+tile_cache_only = False  # offline mode: only use cached images, images not in the cache are treated as failures
+
+# run report: timings of each stage (download, decode, inference & Postgres writes), queue depths, throughput & memory
+# use - saved as JSON at the end of each run (None = don't save)
+run_report_path = os.path.abspath(__file__).replace(".py", "_report.json")
+
+# also save the run report in Prometheus' text format, e.g. for node_exporter's textfile collector
+# (a .prom file in the collector's directory). None = don't save
+prometheus_file_path = None
+
 # ------------------------------------------------------------------------------------------------------------------
 # END: edit settings
 # ------------------------------------------------------------------------------------------------------------------
@@ -99,73 +187,301 @@ height = width
 image_width = 640
 image_height = image_width
 
+# distance between neighbouring images in pixels & degrees (less than the image size if images overlap)
+# note: images are square, so the pixel distance is the same across & down
+use_grid_table = use_reference_data and clip_boundary_path is None
+tile_stride_pixels = image_width if use_grid_table else round(image_width * (1.0 - tile_overlap))
+x_stride = width * (tile_stride_pixels / image_width)
+y_stride = height * (tile_stride_pixels / image_height)
+
+# overlapping images: labels are the same pool if this fraction of the smaller label is covered by the other
+label_merge_threshold = 0.5
+
+# overlapping images: labels are held back until the images next to them are done (to merge with their labels).
+# These cap the number of labels held back & the number of done images remembered (to limit memory use)
+max_held_label_count = 100000
+max_done_image_count = 20000
+
 # process images in chunks to manage memory usage (if using a GPU)
 image_limit = 250  # roughly 8Gb RAM for this model but can spike (GPUs have a 15Gb limit that can crash this script)
 
+# the batch size starts at the image limit and then grows or shrinks to keep the model's peak memory use under this
+# budget (GPU memory per GPU; or for CPUs, process memory (RSS) shared between the CPU processes). On CPUs the batch
+# size doesn't grow past the image limit (i.e. the batch size picked by the CPU calibration run). Out of memory batches
+# are split & retried
+memory_budget_gb = 12
+max_image_limit = 1000
+
+# decode images straight into one (pinned memory) tensor batch & skip YOLOv5's per image preprocessing (much faster as
+# the images are already the right size). Set to False to use YOLOv5's standard preprocessing of Pillow images
+# (exported models always use fast preprocessing)
+fast_preprocessing = True
+
+# exported models: the min confidence of a label, the overlap (IoU) above which 2 labels are the same pool & the max
+# labels per image (YOLOv5's defaults - the same as the pytorch backend uses)
+label_confidence_threshold = 0.25
+label_iou_threshold = 0.45
+max_labels_per_image = 1000
+
+# max number of downloaded images waiting to be run through the model (caps memory use when downloads get ahead)
+image_queue_depth = max_image_limit
+
+# pre-inference pool filter: skip the model for images with hardly any pool coloured (blue/cyan) pixels in a small
+# thumbnail (most images have no pools). The min fraction of pool coloured pixels to run the model (e.g. 0.0005);
+# None = run the model on every image. Use testing/03_validate_pool_filter.py to check recall vs. images skipped
+pool_filter_min_fraction = None
+pool_filter_thumbnail_size = 80  # pixels (JPEGs are decoded at 1/8 size)
+pool_hue_range = [165, 215]  # degrees
+pool_min_saturation = 0.25
+pool_min_value = 0.35
+
+# recall safeguard: run the model on this fraction of the images the filter skips anyway (their labels are kept). If
+# more than the max miss rate of these have pools (after the min audit count), the filter is turned off for the run
+pool_filter_audit_rate = 0.02
+pool_filter_max_miss_rate = 0.01
+pool_filter_min_audit_count = 100
+
+# how many rows to buffer before copying them into Postgres in bulk (across all output tables); and the longest time
+# rows are buffered for (keeps the run ledger up to date - needed for distributed runs to mark batches as done)
+postgres_flush_size = 10000
+postgres_flush_seconds = 60
+
+# how many images to fetch at a time when streaming images from the database
+grid_fetch_size = 10000
+
+# distributed runs: how long a worker's claim on a batch of images lasts. Claims are renewed every quarter of this
+# while the worker is running; batches claimed by a worker that has died are given to another worker once it expires
+batch_lease_seconds = 600
+
+# name of this worker in distributed runs (host & process ID)
+worker_name = f"{platform.node()}:{os.getpid()}"
+
 # how many parallel processes to run (only used for downloading images, hence can use 2x CPUs safely)
 max_concurrent_downloads = torch.multiprocessing.cpu_count() * 2
 max_postgres_connections = max_concurrent_downloads + 1  # +1 required due to rounding error in process counts below
 
+# WMS connection settings. Each process keeps one HTTP session open for all of its downloads, so connections (and their
+# TLS handshakes) are reused across job groups. The WMS is a single host, so all connections can go to it
+http_keepalive_seconds = 60  # how long idle connections are kept open for reuse
+http_dns_cache_seconds = 600  # how long the WMS's IP address is cached for
+
+# download images from the WMS in "super tiles" of super_tile_size x super_tile_size images & slice them into images in
+# memory; e.g. 4 = one 2560x2560 pixel request for 16 images. Cuts the number of WMS requests (1 = off)
+# note: the WMS has a max image size (4096x4096 pixels for ArcGIS by default). Only used if imagery_source is "wms"
+super_tile_size = 1
+
+# adaptive download concurrency: the number of WMS requests in flight starts at max_concurrent_downloads, grows by 1
+# (per limit's worth of successful requests) while the WMS is healthy; and halves when it's overloaded
+# (429 & 5xx responses, timeouts, dropped connections & responses slower than slow_download_seconds)
+max_download_limit_factor = 4  # the limit can grow to max_concurrent_downloads x this
+slow_download_seconds = 10.0
+
+# failed requests that might work next time are retried after a random wait of up to base seconds x 2^retry number
+download_retry_count = 4
+download_retry_base_seconds = 1.0
+
+# send a duplicate request for an image if the first hasn't finished in this many seconds & use whichever finishes
+# first; cuts the long tail of slow requests (None = off)
+download_hedge_seconds = None
+
 # get count of CUDA enabled GPUs (= 0 for CPU only machines)
 cuda_gpu_count = torch.cuda.device_count()
-# NOTE: YOLOv5 doesn't currently support multi-GPU inference - only 1 GPU is supported
-if cuda_gpu_count > 1:
-    cuda_gpu_count = 1
 
-# alter concurrent download limit if using multiple GPUs
-if cuda_gpu_count > 1:
-    max_concurrent_downloads = math.floor(max_concurrent_downloads / cuda_gpu_count)
+if inference_devices is None and cuda_gpu_count > 0:
+    inference_devices = [f"cuda:{gpu_number}" for gpu_number in range(cuda_gpu_count)]
+
+# process counts & batch sizes tried when auto-tuning CPU only machines (only counts <= the number of cores are tried)
+cpu_tuning_process_counts = [1, 2, 4, 8]
+cpu_tuning_batch_sizes = [8, 16, 32]
+
+# marker put on the image queue once all images have been downloaded
+end_of_images = object()
+
+# rows waiting to be copied into Postgres, by table; and image processing states waiting to be updated, by image
+row_buffers = dict()
+tile_states = dict()
+row_buffer_lock = threading.Lock()
+flush_lock = threading.Lock()  # flushes are done one at a time to keep image states in order
+last_flush_time = time.monotonic()
+
+# background thread that copies buffered rows into Postgres while labelling (so downloads never wait for Postgres);
+# and the event used to wake it up when there are enough rows to flush
+row_writer = None
+flush_requested = threading.Event()
+
+# extended well known binary (EWKB) structures for points & polygons (used to create geometries for the database)
+ewkb_point_dtype = numpy.dtype([("byte_order", "u1"), ("geometry_type", "<u4"), ("srid", "<u4"),
+                                ("x", "<f8"), ("y", "<f8")])
+ewkb_polygon_dtype = numpy.dtype([("byte_order", "u1"), ("geometry_type", "<u4"), ("srid", "<u4"),
+                                  ("ring_count", "<u4"), ("point_count", "<u4"), ("coords", "<f8", (10,))])
+
+# postgres connection pool (created by each process when it starts)
+pg_pool = None
 
-# create postgres connection pool (accessible across multiple processes)
-pg_pool = psycopg2.pool.SimpleConnectionPool(1, max_postgres_connections, pg_connect_string)
+# bounds of each file in the GeoTIFF mosaic (created on first use); and the files each thread has open (rasterio files
+# can't be shared between threads)
+geotiff_index = None
+geotiff_index_lock = threading.Lock()
+geotiff_thread_data = threading.local()
 
+# top left lat/long of the grid of images (set when the job list is created)
+grid_origin = None
+
+# number of images claimed by this worker (distributed runs)
+claimed_image_count = 0
+
+# distributed runs: only write results for batches this worker still has a claim on (see fence_rows())
+fence_batch_writes = False
+
+# overlapping images: flags of the grid positions (row, column) of the images in the run that aren't done yet. Labels
+# only wait on these images (see set_run_image_grid())
+run_image_grid = None
+
+# labels held back to be merged with labels in overlapping images (created when labelling starts if images overlap);
+# and the queue labels are sent to the main process on for merging (if using multiple devices)
+label_merge = None
+label_merge_queue = None
+
+# adaptive limit on WMS requests in flight & download counts (one of each per process, created when downloads start)
+download_limiter = None
+download_stats = None
+
+# bytes this process has written to the tile cache since it was last trimmed
+tile_cache_written_bytes = 0
+tile_cache_lock = threading.Lock()
+
+# reusable batch of decoded images (one per process, created on first use)
+image_batch_buffer = None
+
+# peak RSS of this process before its last reset (CPUs only - see reset_peak_memory_used())
+peak_rss_bytes = 0
+
+# run metrics: histograms of stage timings & queue depths, counts & peak memory use (one set per process - processes
+# send theirs to the main process when they finish). See record_timing(), count_metric() & save_run_report()
+run_metrics = {"histograms": dict(), "counts": dict(), "memory": list()}
+run_metric_lock = threading.Lock()
+
+# histogram buckets (upper bounds) for timings (seconds) & queue depths (items)
+timing_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf]
+depth_buckets = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, math.inf]
+
+# pool filter counts (one per process)
+pool_filter_stats = {"image_count": 0, "skipped_image_count": 0, "audit_image_count": 0,
+                     "audit_pool_image_count": 0, "turned_off": False}
+
+
+def main(args):
+    global max_concurrent_downloads
+    global pg_pool
+    global fence_batch_writes
 
-def main():
     full_start_time = datetime.now()
 
     logger.info(f"START : swimming pool labelling : {full_start_time}")
+    logger.info(f"\t - imagery source : {imagery_source}")
+
+    # create postgres connection pool (thread safe - it's shared by the download, row writer & label merge threads)
+    pg_pool = psycopg2.pool.ThreadedConnectionPool(1, max_postgres_connections, pg_connect_string)
+
+    # copy any buffered rows into Postgres if the script stops early
+    atexit.register(flush_rows)
 
     # get postgres connection from pool
     pg_conn = pg_pool.getconn()
     pg_conn.autocommit = True
     pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-    # clean out target tables
-    pg_cur.execute(f"truncate table {label_table}")
-    pg_cur.execute(f"truncate table {image_table}")
+    if args.worker:
+        # distributed run: the run has been set up by --seed; partial results are removed as batches are claimed
+        logger.info(f"Worker {worker_name} : claiming image batches from {batch_table}")
+    elif args.resume:
+        # keep the last run's results and remove any partial results for images that didn't finish
+        pg_cur.execute(f"select count(*) from {tile_table} where state = 'inferred'")
+        logger.info(f"Resuming previous run : {int(pg_cur.fetchone()[0])} images already done")
+
+        for table_name in [label_table, image_table]:
+            pg_cur.execute(f"""delete from {table_name} as tab
+                               using {tile_table} as tile
+                               where tab.file_path = tile.file_path
+                                 and tile.state <> 'inferred'""")
+    else:
+        # clean out target tables
+        pg_cur.execute(f"truncate table {label_table}")
+        pg_cur.execute(f"truncate table {image_table}")
+        pg_cur.execute(f"truncate table {tile_table}")
+
+    if args.seed:
+        # distributed run: fill the run ledger & split the images into batches for workers to claim
+        image_count, _ = get_jobs(args.resume)
+        batch_count = seed_batches()
+        logger.info(f"{image_count} images queued in {batch_count} batches : {datetime.now() - full_start_time}")
+
+        # clean up postgres connection
+        pg_cur.close()
+        pg_pool.putconn(pg_conn)
+
+        return
 
     # -----------------------------------------------------------------------------------------------------------------
     # Create a multiprocessing job list to download and label the images using available GPUs (or CPUs if no GPUs)
     # -----------------------------------------------------------------------------------------------------------------
 
-    image_count, jobs_by_gpu = get_jobs()
+    # CPU only machines: run the model in multiple processes, each using a share of the CPU cores
+    if inference_devices is None:
+        set_cpu_devices()
+
+    # alter concurrent download limit if using multiple devices (each device's process downloads its own images)
+    if len(inference_devices) > 1:
+        max_concurrent_downloads = math.floor(max_concurrent_downloads / len(inference_devices))
+
+    if args.worker:
+        if use_super_tiles() or use_label_merge():
+            set_grid_origin_from_ledger()
 
-    # NOTE: YOLOv5 doesn't currently support multi-GPU inference - code is a placeholder
-    if cuda_gpu_count > 1:
-        # required for torch multiprocessing on GPUs
-        torch.multiprocessing.set_start_method("spawn", force=True)
+        fence_batch_writes = True
 
-        # assign a GPU number to each set of job group (1 set of groups per GPU)
-        mp_job_list = list()
-        gpu_number = 0
-        for job_groups in jobs_by_gpu:
-            mp_job_list.append([job_groups, gpu_number])
-            gpu_number += 1
+        # claim batches of images from the work queue as they're needed; renewing the claims in the background
+        job_groups = claim_job_groups()
+        heartbeat_stop = threading.Event()
+        heartbeat_thread = threading.Thread(target=run_batch_heartbeat, args=(heartbeat_stop,), daemon=True)
+        heartbeat_thread.start()
 
-        mp_pool = torch.multiprocessing.Pool(cuda_gpu_count)
-        mp_results = mp_pool.imap_unordered(get_labels, mp_job_list)
-        mp_pool.close()
-        mp_pool.join()
+        logger.info(f"Processing claimed images on {len(inference_devices)} device(s) : {', '.join(inference_devices)}")
+    else:
+        image_count, job_groups = get_jobs(args.resume)
+
+        logger.info(f"{image_count} images to process on {len(inference_devices)} device(s) : {', '.join(inference_devices)}")
 
-        total_label_count = 0
-        total_image_fail_count = 0
+    # overlapping images: get the images labels can wait on (workers add them as they claim batches)
+    if use_label_merge():
+        set_run_image_grid(flag_images=not args.worker)
 
-        for label_count, image_fail_count in mp_results:
-            total_label_count += label_count
-            total_image_fail_count += image_fail_count
+    labelling_start_time = time.perf_counter()
 
+    if len(inference_devices) > 1:
+        total_label_count, total_image_fail_count = get_labels_on_all_devices(job_groups)
     else:
-        total_label_count, total_image_fail_count = get_labels([jobs_by_gpu[0], 0])
+        total_label_count, total_image_fail_count = get_labels(inference_devices[0], job_groups)
+
+    labelling_seconds = time.perf_counter() - labelling_start_time
+
+    if args.worker:
+        # stop renewing claims & mark this worker's last batches as done
+        heartbeat_stop.set()
+        heartbeat_thread.join()
+        flush_rows()
+        update_batches(pg_cur)
+
+        image_count = claimed_image_count
+
+        # let the last worker to finish tag the labels (once all batches are done)
+        pg_cur.execute(f"select count(*) from {batch_table} where state <> 'done'")
+        batches_left = int(pg_cur.fetchone()[0])
+        logger.info(f"Worker {worker_name} : {batches_left} batches left in the work queue")
+
+    # remove the least recently used images if the tile cache has outgrown its limit
+    if tile_cache_dir is not None:
+        trim_tile_cache()
 
     # show image download results
     logger.info(f"{image_count} images downloaded into memory")
@@ -176,7 +492,12 @@ def main():
     # label_file_count = 0
     # no_label_file_count = 0
 
-    if use_reference_data:
+    if use_reference_data and (not args.worker or batches_left == 0):
+        # tag all labels with their land parcel and address IDs in one pass
+        start_time = datetime.now()
+        tagged_label_count = tag_labels_with_parcel_and_address_ids()
+        logger.info(f"{tagged_label_count} labels tagged with parcel & address IDs : {datetime.now() - start_time}")
+
         # get counts of missing parcels and addresses
         pg_cur.execute(f"select count(*) from {label_table} where legal_parcel_id is NULL")
         row = pg_cur.fetchone()
@@ -195,410 +516,2798 @@ def main():
     pg_cur.close()
     pg_pool.putconn(pg_conn)
 
+    # log stage timings & save the run report
+    run_summary = dict()
+    run_summary["start_time"] = full_start_time.isoformat()
+    run_summary["end_time"] = datetime.now().isoformat()
+    run_summary["worker"] = worker_name
+    run_summary["imagery_source"] = imagery_source
+    run_summary["inference_devices"] = inference_devices
+    run_summary["image_count"] = image_count
+    run_summary["image_fail_count"] = total_image_fail_count
+    run_summary["label_count"] = total_label_count
+    run_summary["labelling_seconds"] = labelling_seconds
+    run_summary["images_per_second"] = image_count / max(labelling_seconds, 0.001)
+
+    logger.info(f"Run metrics : {run_summary['images_per_second']:.1f} images/sec")
+    save_run_report(run_summary)
+
     logger.info(f"FINISHED : swimming pool labelling : {datetime.now() - full_start_time}")
 
 
-def get_jobs():
-    """Create job list by getting list of lat/longs from Postgres table or user defined min/max coords.
-       Then split jobs based on:
-         a. the number of GPUs being used (if any); AND
-         b. The max number of images to be processed in a single go by each GPU (to control memory usage)"""
+def set_cpu_devices():
+    """Sets the number of CPU processes to run the model in, the number of threads each one uses & the batch size.
+       Auto-tunes these using a short calibration run if the number of processes isn't set"""
 
-    if use_reference_data:
-        # reference grid method - get lat/longs from Postgres table
+    global inference_devices
+    global cpu_thread_count
+    global image_limit
 
-        # get postgres connection from pool
-        pg_conn = pg_pool.getconn()
-        pg_conn.autocommit = True
-        pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    core_count = torch.multiprocessing.cpu_count()
 
-        pg_cur.execute(f"select distinct latitude, longitude from {grid_table}")
-        rows = pg_cur.fetchall()
+    if cpu_process_count is None:
+        process_count, cpu_thread_count, image_limit = tune_cpu_settings(core_count)
+    else:
+        process_count = cpu_process_count
+        if cpu_thread_count is None:
+            cpu_thread_count = max(math.floor(core_count / process_count), 1)
 
-        job_list = [[row[0], row[1]] for row in rows]
-        image_count = len(job_list)
+    inference_devices = ["cpu"] * process_count
 
-        # clean up postgres connection
-        pg_cur.close()
-        pg_pool.putconn(pg_conn)
-    else:
-        # user defined min/max coords - create grid mathematically
-
-        job_list = list()
-        image_count = 0
-        latitude = input_y_max
-
-        while latitude > input_y_min:
-            longitude = input_x_min
-            while longitude < input_x_max:
-                image_count += 1
-                job_list.append([latitude, longitude])
-                longitude += width
-            latitude -= height
-
-    # split jobs by number of GPUs and limit per job group
-    jobs_by_gpu = list()
-
-    # NOTE: YOLOv5 doesn't currently support multi-GPU inference - code is a placeholder
-    if cuda_gpu_count > 1:
-        # 1. split jobs into even groups by GPU
-        jobs_per_gpu = math.ceil(len(job_list) / cuda_gpu_count)
-        temp_job_groups = list(split_list(job_list, jobs_per_gpu))
-
-        # 2. split each GPUs workload into "fits in memory" sized chunks
-        for temp_job_group in temp_job_groups:
-            job_groups = list(split_list(temp_job_group, image_limit))
-            jobs_by_gpu.append(job_groups)
+    logger.info(f"CPU settings : {process_count} processes x {cpu_thread_count} threads : batch size of {image_limit}")
 
-    else:
-        job_groups = list(split_list(job_list, image_limit))
-        jobs_by_gpu.append(job_groups)
 
-    return image_count, jobs_by_gpu
+def tune_cpu_settings(core_count):
+    """Picks the number of CPU processes (and threads per process) & the batch size with the best throughput by timing
+       the model on random images in this process. Estimates throughput as processes x the throughput of one process
+       using its share of the cores; which is close enough while processes x threads <= cores"""
 
+    global run_metrics
+    global cpu_thread_count
 
-def split_list(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+    start_time = datetime.now()
 
+    # keep the calibration runs' timings out of the run metrics
+    saved_run_metrics = run_metrics
+    run_metrics = {"histograms": dict(), "counts": dict(), "memory": list()}
 
-def get_labels(job):
-    """Downloads images asynchronously & in parallel then runs them through the model to detect pools"""
+    # the model's speed doesn't depend on what's in the image, so random images save downloading real ones
+    image_list = list()
+    for _ in range(max(cpu_tuning_batch_sizes)):
+        image_array = torch.randint(0, 256, (image_height, image_width, 3), dtype=torch.uint8).numpy()
+        image_file = io.BytesIO()
+        Image.fromarray(image_array).save(image_file, format="JPEG")
+        image_list.append(image_file.getvalue())
 
-    job_groups = job[0]
-    gpu_number = job[1]
+    default_thread_count = torch.get_num_threads()
 
-    # get job counts
-    job_count = 0
-    for job_group in job_groups:
-        job_count += len(job_group)
+    model = None
+    best_settings = None
+    best_rate = 0.0
 
-    # load trained model to run on selected GPU (or CPUs)
-    if torch.cuda.is_available():
-        device_tag = f"cuda:{gpu_number}"
-    else:
-        device_tag = "cpu"
+    for process_count in [count for count in cpu_tuning_process_counts if count <= core_count]:
+        thread_count = max(math.floor(core_count / process_count), 1)
+        torch.set_num_threads(thread_count)
 
-    device = torch.device(device_tag)
-    model = torch.hub.load(yolo_home, "custom", path=model_path, source="local")
-    model.to(device)
+        # ONNX Runtime sessions have their own thread pool (sized by cpu_thread_count when they're created) - create
+        # one per thread count. cpu_thread_count is set to the best thread count once tuning is done
+        if model is None or inference_backend == "onnx":
+            cpu_thread_count = thread_count
+            model = load_model(torch.device("cpu"))
 
-    total_image_fail_count = 0
-    total_label_count = 0
-    i = 0
+        # warm up the model for this thread count
+        detect_pools(model, torch.device("cpu"), image_list[:1])
 
-    # for each job group download images and detect labels on them
-    for job_group in job_groups:
-        start_time = datetime.now()
+        for batch_size in cpu_tuning_batch_sizes:
+            batch_start_time = time.perf_counter()
+            detect_pools(model, torch.device("cpu"), image_list[:batch_size])
+            rate = process_count * batch_size / (time.perf_counter() - batch_start_time)
 
-        i += len(job_group)
+            if rate > best_rate:
+                best_rate = rate
+                best_settings = [process_count, thread_count, batch_size]
 
-        # Download images into memory, asynchronously in parallel
-        loop = asyncio.get_event_loop()
-        image_download_list = loop.run_until_complete(async_get_images(job_group))
+    torch.set_num_threads(default_thread_count)
 
-        # get rid of image download failures and count them
-        coords_list = list()
-        image_list = list()
-        image_fail_count = 0
-        for image_download in image_download_list:
-            if image_download is not None:
-                coords_list.append(image_download[0])
-                image_list.append(image_download[1])
-            else:
-                image_fail_count += 1
+    run_metrics = saved_run_metrics
 
-        total_image_fail_count += image_fail_count
+    logger.info(f"CPU settings tuned : ~{best_rate:.1f} images/sec : {datetime.now() - start_time}")
 
-        # logger.info(f"\t - {device_tag} : group {i} of {job_count} : images downloaded : {datetime.now() - start_time}")
-        # start_time = datetime.now()
+    return best_settings
 
-        # run inference
-        results = model(image_list)
-        tensor_labels = results.xyxy
 
-        # DEBUG: save labelled images
-        # results.save(os.path.join(script_dir, "output"))
+def get_jobs(resume):
+    """Create job list by getting list of lat/longs from Postgres table or user defined min/max coords
+       (or the unfinished images in the run ledger if resuming a run).
+       Then split jobs into groups of images; to be shared out to the devices running the model.
+       Jobs aren't held in memory - the job groups are generated (or streamed from the database) as they're needed"""
 
-        # logger.info(f"\t - {device_tag} : group {i} of {job_count} : pool detection done : {datetime.now() - start_time}")
-        # start_time = datetime.now()
+    # split jobs into groups. Devices take a group at a time, so faster devices end up doing more groups
+    job_group_size = get_job_group_size()
 
-        # step through each group of results and export to database
-        j = 0
+    if not resume:
+        if use_grid_table:
+            # reference grid method - copy lat/longs from Postgres table into the run ledger (as pending) on the server
+            add_grid_table_jobs_to_ledger()
+        else:
+            # user defined min/max coords (or boundary) - create grid mathematically, as it's needed
+            grid_bounds = get_grid_bounds()
+            set_grid_origin([[round(grid_bounds[3], 7), round(grid_bounds[0], 7)]])
 
-        for tensor_label in tensor_labels:
-            label_list = tensor_label.tolist()
+            # add all images to the run ledger as pending (done before the first download, so the ledger is complete
+            # before any image states are updated)
+            image_count = add_jobs_to_ledger(get_grid_coords(grid_bounds))
 
-            label_count = len(label_list)
-            if label_count > 0:
-                total_label_count += label_count
+            return image_count, split_list(get_grid_coords(grid_bounds), job_group_size)
 
-                # get corresponding coords of image (used to create ID to match
-                latitude = coords_list[j][0]
-                longitude = coords_list[j][1]
+    # stream the images that aren't done yet from the run ledger (all of them if it's a new run)
 
-                # DEBUG: save labels to disk
-                # f = open(os.path.join(script_dir, "labels", f"test_image_{latitude}_{longitude}.txt"), "w")
-                # f.write("\n".join(" ".join(map(str, row)) for row in results_list))
-                # f.close()
-                # logger.info(f"Image {latitude}, {longitude} has {label_count} pools")
+    # get postgres connection from pool
+    pg_conn = pg_pool.getconn()
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-                import_labels_to_postgres(latitude, longitude, label_list)
+    pg_cur.execute(f"select count(*) from {tile_table} where state <> 'inferred'")
+    image_count = int(pg_cur.fetchone()[0])
 
-            j += 1
+    # clean up postgres connection
+    pg_cur.close()
+    pg_pool.putconn(pg_conn)
 
-        logger.info(f"\t - {device_tag} : group {i} of {job_count} : done : {datetime.now() - start_time} : {total_label_count} total labels detected")
+    if use_super_tiles() or use_label_merge():
+        set_grid_origin_from_ledger()
 
-    return total_label_count, total_image_fail_count
+    sql = f"select latitude, longitude from {tile_table} where state <> 'inferred' {get_job_order_by()}"
 
+    return image_count, split_list(stream_coords(sql), job_group_size)
 
-async def async_get_images(job_list):
-    """Sets up the asynchronous downloading of images in parallel"""
 
-    conn = aiohttp.TCPConnector(limit=max_concurrent_downloads)
+def set_grid_origin_from_ledger():
+    """Sets the top left of the grid of images from all images in the run ledger (the same for every worker)"""
 
-    async with aiohttp.ClientSession(connector=conn, trust_env=True) as session:
-        # create job list to do asynchronously
-        process_list = []
-        for coords in job_list:
-            process_list.append(get_image(session, coords))
+    global grid_origin
 
-        # execute them all at once and return list of downloading images
-        return await asyncio.gather(*process_list)
+    # get postgres connection from pool
+    pg_conn = pg_pool.getconn()
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor()
 
+    pg_cur.execute(f"select max(latitude), min(longitude) from {tile_table}")
+    row = pg_cur.fetchone()
 
-async def get_image(session, coords):
-    """Downloads an image from a Web Map service (WMS) service into memory, saves it's bounds (as a polygon) to Postgres
-       and returns a pillow image
+    if row is not None and row[0] is not None:
+        grid_origin = [row[0], row[1]]
 
-       Note: map coords are top/left (normally bottom/left) to match pixel coordinate convention)"""
+    # clean up postgres connection
+    pg_cur.close()
+    pg_pool.putconn(pg_conn)
 
-    latitude = coords[0]
-    longitude = coords[1]
 
-    # try:
-        # response = wms.getmap(
-        #     layers=["0"],
-        #     srs='EPSG:4326',
-        #     bbox=(longitude, latitude - height, longitude + width, latitude),
-        #     format="image/jpeg",
-        #     size=(image_width, image_height)
-        # )
+def get_job_group_size():
+    """Gets the number of images in a job group (a whole number of super tiles if using them)"""
 
-    # querystring parameters
-    params = dict()
-    params["service"] = "WMS"
-    params["request"] = "GetMap"
-    params["version"] = "1.3.0"
-    params["layers"] = 0
-    params["styles"] = ""
-    params["crs"] = "epsg:4326"
-    params["bbox"] = f"{longitude},{latitude - height},{longitude + width},{latitude}"
-    params["width"] = image_width
-    params["height"] = image_height
-    params["format"] = "image/jpeg"
+    if use_super_tiles():
+        return math.ceil(image_limit / super_tile_size ** 2) * super_tile_size ** 2
 
-    try:
-        # download image
-        async with session.get(wms_base_url, params=params) as response:
-            response = await response.read()
+    return image_limit
 
-        # convert response to a Pillow image
-        image_file = io.BytesIO(response)
-        image = Image.open(image_file)
 
-        # TESTING - need to convert images to tensors to enable multi-GPU processing.
-        # Note: YOLOv5 authors claim multi-GPU can't be done.
-        # tensor_image = transforms.ToTensor()(image).unsqueeze_(0)
-        # # print(tensor_image.shape)
+def seed_batches():
+    """Distributed runs: splits the images in the run ledger that aren't done into batches (in the same order they'd be
+       processed in) & queues them for workers to claim. Returns the number of batches"""
 
-        # DEBUG: save image to disk
-        # image.save(os.path.join(script_dir, "input", f"image_{latitude}_{longitude}.jpg" ))
+    if use_super_tiles() or use_label_merge():
+        set_grid_origin_from_ledger()
 
-        # export image polygon & metadata to Postgres
-        import_image_to_postgres(latitude, longitude)
+    # get postgres connection from pool
+    pg_conn = pg_pool.getconn()
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor()
 
-        return [latitude, longitude], image
+    pg_cur.execute(f"truncate table {batch_table}")
 
-    except Exception as ex:
-        # request most likely timed out
-        logger.warning(f"Image download {latitude}, {longitude} FAILED: {ex}")
-        return None
+    pg_cur.execute(f"""update {tile_table} as tile
+                           set batch_id = batched.batch_id
+                       from (select file_path,
+                                    (row_number() over ({get_job_order_by()}) - 1) / {get_job_group_size()} as batch_id
+                             from {tile_table}
+                             where state <> 'inferred') as batched
+                       where tile.file_path = batched.file_path""")
 
+    pg_cur.execute(f"""insert into {batch_table} (batch_id, state)
+                       select distinct batch_id, 'pending'
+                       from {tile_table}
+                       where state <> 'inferred'""")
+    batch_count = pg_cur.rowcount
 
-def make_wkt_point(x_centre, y_centre):
-    """Creates a well known text (WKT) point geometry for insertion into database"""
-    return f"POINT({x_centre} {y_centre})"
+    # clean up postgres connection
+    pg_cur.close()
+    pg_pool.putconn(pg_conn)
 
+    return batch_count
 
-def make_wkt_polygon(x_min, y_min, x_max, y_max):
-    """Creates a well known text (WKT) polygon geometry for insertion into database"""
-    return f"POLYGON(({x_min} {y_min}, {x_min} {y_max}, {x_max} {y_max}, {x_max} {y_min}, {x_min} {y_min}))"
 
+def claim_job_groups():
+    """Distributed runs: claims batches of images from the work queue one at a time (skipping batches other workers are
+       claiming) & yields each batch's images as a job group. Batches with an expired claim (from a worker that died)
+       are claimed again - their partial results are removed first, so results are only written once"""
 
-def convert_label_to_polygon(latitude, longitude, label):
-    """Takes a detected label & converts it to centroid & boundary geometries for insertion into database
+    global claimed_image_count
 
-    format of label list is:
-      0 - left pixel
-      1 - top pixel
-      2 - right pixel
-      3 - bottom pixel
-      4 - confidence (0.00 to 1.00)
-      5 - unknown (class? always 0.0)
+    # batches claimed by this worker. A batch is never claimed twice by the same worker - if its claim expired, images
+    # from its first claim could still be in the pipeline (& would get through the write fence in fence_rows())
+    claimed_batch_ids = list()
 
-    e.g. [364.4530029296875, 480.5206298828125, 393.81219482421875, 512.9512939453125, 0.9367147088050842, 0.0]"""
+    # get postgres connection from pool
+    pg_conn = pg_pool.getconn()
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor()
 
-    # these pixel coords need to be converted to percentages
-    label_left = float(label[0]) / float(image_width)
-    label_top = float(label[1]) / float(image_height)
-    label_right = float(label[2]) / float(image_width)
-    label_bottom = float(label[3]) / float(image_height)
+    try:
+        while True:
+            pg_cur.execute(f"""with next_batch as (
+                                   select batch_id
+                                   from {batch_table}
+                                   where (state = 'pending'
+                                          or (state = 'claimed' and lease_expires < now()))
+                                     and batch_id <> all(%s)
+                                   order by batch_id
+                                   limit 1
+                                   for update skip locked
+                               )
+                               update {batch_table} as batch
+                                   set state = 'claimed',
+                                       worker = %s,
+                                       lease_expires = now() + %s * interval '1 second',
+                                       attempts = batch.attempts + 1
+                               from next_batch
+                               where batch.batch_id = next_batch.batch_id
+                               returning batch.batch_id, batch.attempts""",
+                           (claimed_batch_ids, worker_name, batch_lease_seconds))
+            row = pg_cur.fetchone()
+
+            if row is None:
+                # nothing to claim - wait for other workers' batches to finish (or their claims to expire) before
+                # stopping, in case a worker has died (batches this worker can't claim again are left for other workers)
+                pg_cur.execute(f"""select count(*)
+                                   from {batch_table}
+                                   where state = 'claimed'
+                                     and worker <> %s
+                                     and (lease_expires >= now() or batch_id <> all(%s))""",
+                               (worker_name, claimed_batch_ids))
+                if int(pg_cur.fetchone()[0]) == 0:
+                    break
+
+                # let other workers know which of this worker's batches are done while waiting
+                flush_rows()
+                update_batches(pg_cur)
+
+                time.sleep(min(batch_lease_seconds / 4.0, postgres_flush_seconds))
+                continue
+
+            batch_id = int(row[0])
+            claimed_batch_ids.append(batch_id)
+
+            if int(row[1]) > 1:
+                # a worker died part way through this batch - remove its partial results
+                logger.warning(f"\t - reclaiming batch {batch_id} (attempt {int(row[1])})")
+
+                for table_name in [label_table, image_table]:
+                    pg_cur.execute(f"""delete from {table_name} as tab
+                                       using {tile_table} as tile
+                                       where tab.file_path = tile.file_path
+                                         and tile.batch_id = %s
+                                         and tile.state <> 'inferred'""", (batch_id,))
+
+            pg_cur.execute(f"""select latitude, longitude
+                               from {tile_table}
+                               where batch_id = %s
+                                 and state <> 'inferred'
+                               {get_job_order_by()}""", (batch_id,))
+            job_group = [[row[0], row[1]] for row in pg_cur.fetchall()]
+
+            if len(job_group) == 0:
+                # all done by the last worker to claim it
+                update_batches(pg_cur)
+                continue
+
+            claimed_image_count += len(job_group)
+
+            # overlapping images: labels can wait on images this worker has claimed, but not on images in other
+            # workers' batches (they'd never be done here)
+            if run_image_grid is not None:
+                flag_run_images(job_group)
+
+            yield job_group
+    finally:
+        # clean up postgres connection
+        pg_cur.close()
+        pg_pool.putconn(pg_conn)
 
-    confidence = float(label[4])
 
-    # get lat/long boundary by converting pixel coords to real world coords
-    x_min = longitude + width * label_left
-    y_min = latitude - height * label_bottom
-    x_max = longitude + width * label_right
-    y_max = latitude - height * label_top
+def run_batch_heartbeat(stop_event):
+    """Distributed runs: renews this worker's claims on its batches & marks finished batches as done, until stopped.
+       Uses its own Postgres connection (it runs in a background thread)"""
 
-    # get centroid lat/long
-    x_centre = (x_min + x_max) / 2.0
-    y_centre = (y_min + y_max) / 2.0
+    pg_conn = psycopg2.connect(pg_connect_string)
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor()
 
-    # create well known text (WKT) geometries
-    point = make_wkt_point(x_centre, y_centre)
-    polygon = make_wkt_polygon(x_min, y_min, x_max, y_max)
+    while not stop_event.wait(batch_lease_seconds / 4.0):
+        try:
+            update_batches(pg_cur)
+        except Exception as ex:
+            logger.warning(f"\t - couldn't renew batch claims : {ex}")
 
-    return confidence, y_centre, x_centre, point, polygon
+    pg_cur.close()
+    pg_conn.close()
+
+
+def update_batches(pg_cur):
+    """Distributed runs: marks this worker's batches as done if all their images are done (inferred or failed); and
+       renews its claims on the rest"""
+
+    pg_cur.execute(f"""update {batch_table} as batch
+                           set state = 'done',
+                               lease_expires = NULL
+                       where batch.worker = %s
+                         and batch.state = 'claimed'
+                         and not exists (select 1
+                                         from {tile_table} as tile
+                                         where tile.batch_id = batch.batch_id
+                                           and tile.state in ('pending', 'downloaded'))""", (worker_name,))
+
+    pg_cur.execute(f"""update {batch_table}
+                           set lease_expires = now() + %s * interval '1 second'
+                       where worker = %s
+                         and state = 'claimed'""", (batch_lease_seconds, worker_name))
+
+
+def get_job_order_by():
+    """Gets the order by clause to stream images from the run ledger in. Images are sorted by super tile if using them
+       (to keep each super tile's images together, in the same group); otherwise by the grid order setting"""
+
+    if use_super_tiles():
+        return f"""order by round(({grid_origin[0]} - latitude) / {y_stride})::bigint / {super_tile_size},
+                            round((longitude - {grid_origin[1]}) / {x_stride})::bigint / {super_tile_size},
+                            latitude desc,
+                            longitude"""
+    elif grid_order == "geohash":
+        return "order by st_geohash(st_setsrid(st_makepoint(longitude, latitude), 4326))"
+    elif grid_order == "hilbert":
+        return "order by st_makepoint(longitude, latitude)"
+    else:
+        return ""
 
 
-def get_parcel_and_address_ids(latitude, longitude):
-    """Takes a label's point and gets its address and land parcel IDs from the database.
-    Returns None if no match (possible due to the vagaries of addressing & land titling)"""
+def stream_coords(sql):
+    """Streams lat/longs from the database using a server-side (named) cursor; fetching a chunk of rows at a time
+       (the whole result is never held in memory)"""
 
-    # get postgres connection from pool
+    # get postgres connection from pool (server-side cursors only exist inside a transaction)
     pg_conn = pg_pool.getconn()
-    pg_conn.autocommit = True
-    pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    pg_conn.autocommit = False
 
-    # get legal parcel ID and address ID using spatial join (joining on legal parcel ID is flaky due to GNAF's approach)
-    sql = f"""select cad.jurisdiction_id, 
-                     gnaf.gnaf_pid, 
-                     concat(gnaf.address, ', ', gnaf.locality_name, ' ', gnaf.state, ' ', gnaf.postcode) as address
-              from {cad_table} as cad
-              inner join {gnaf_table} as gnaf on st_intersects(gnaf.geom, cad.geom)
-              where st_intersects(st_setsrid(st_makepoint({longitude}, {latitude}), 4283), cad.geom)"""
-    pg_cur.execute(sql)
+    try:
+        pg_cur = pg_conn.cursor(name="coords_cursor")
+        pg_cur.itersize = grid_fetch_size
+        pg_cur.execute(sql)
 
-    # TODO: import more than the first result.
-    #   Can return multiple addresses due to strata titles & the realities of 3D land titling
-    row = pg_cur.fetchone()
+        for row in pg_cur:
+            yield [row[0], row[1]]
 
-    legal_parcel_id = None
-    gnaf_pid = None
-    address = None
+        pg_cur.close()
+    finally:
+        # clean up postgres connection
+        pg_conn.rollback()
+        pg_conn.autocommit = True
+        pg_pool.putconn(pg_conn)
 
-    if row is not None:
-        legal_parcel_id = row[0]
-        gnaf_pid = row[1]
-        address = row[2]
 
-    # clean up postgres connection
-    pg_cur.close()
-    pg_pool.putconn(pg_conn)
+def add_jobs_to_ledger(jobs):
+    """Adds images to the run ledger as pending & returns the number of images"""
 
-    # print(f"{legal_parcel_id} : {gnaf_pid}")
+    image_count = 0
+    columns = ["file_path", "latitude", "longitude", "state"]
 
-    return legal_parcel_id, gnaf_pid, address
+    for coords_list in split_list(jobs, grid_fetch_size):
+        insert_rows(tile_table, columns,
+                    [[get_image_file_path(coords[0], coords[1]), coords[0], coords[1], "pending"]
+                     for coords in coords_list])
 
+        image_count += len(coords_list)
+
+    flush_rows()
+
+    return image_count
 
-def insert_row(table_name, row):
-    """Inserts a python dictionary as a new row into a database table.
-    Allows for any number of columns and types; but column names and types MUST match existing columns"""
+
+def add_grid_table_jobs_to_ledger():
+    """Adds the images in the grid table to the run ledger as pending, in one statement on the server (the grid doesn't
+       come through Python). Returns the number of images"""
 
     # get postgres connection from pool
     pg_conn = pg_pool.getconn()
     pg_conn.autocommit = True
-    pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-    # get column names & values (dict keys must match existing table columns)
-    columns = list(row.keys())
-    values = [row[column] for column in columns]
-
-    insert_statement = f"INSERT INTO {table_name} (%s) VALUES %s"
-    sql = pg_cur.mogrify(insert_statement, (AsIs(','.join(columns)), tuple(values))).decode("utf-8")
-    pg_cur.execute(sql)
+    pg_cur = pg_conn.cursor()
+
+    # image IDs must match get_image_file_path() - shortest round trip float text (Postgres 12+) is the same as
+    # Python's, except whole numbers need a ".0" on the end
+    pg_cur.execute("set extra_float_digits = 1")
+    pg_cur.execute(f"""insert into {tile_table} (file_path, latitude, longitude, state)
+                       select 'image_' || {get_float_text_sql("latitude")} || '_'
+                                  || {get_float_text_sql("longitude")} || '.jpg', latitude, longitude, 'pending'
+                       from (select distinct latitude::double precision as latitude,
+                                             longitude::double precision as longitude
+                             from {grid_table}) as grid""")
+    image_count = pg_cur.rowcount
+
+    # check a sample of the image IDs, as a mismatch would stop images being marked as done
+    pg_cur.execute(f"select file_path, latitude, longitude from {tile_table} limit 1000")
+    for file_path, latitude, longitude in pg_cur.fetchall():
+        if file_path != get_image_file_path(latitude, longitude):
+            raise Exception(f"image ID made by Postgres ({file_path}) doesn't match "
+                            f"{get_image_file_path(latitude, longitude)} - needs Postgres 12+")
 
     # clean up postgres connection
     pg_cur.close()
     pg_pool.putconn(pg_conn)
 
+    return image_count
 
-def import_labels_to_postgres(latitude, longitude, label_list):
-    """Inserts a list of labels into the database"""
 
-    # TODO: come up with a more meaningful ID for linking images with labels
-    image_path = f"image_{latitude}_{longitude}.jpg"
+def get_float_text_sql(column_name):
+    """Gets the SQL to convert a double precision column to the same text as Python's str() of a float"""
 
-    # insert row for each line in file (TODO: insert in one block of sql statements for performance lift)
-    for label in label_list:
-        label_row = dict()
-        label_row["file_path"] = image_path
+    return f"case when {column_name} = trunc({column_name}) " \
+           f"then trunc({column_name})::bigint::text || '.0' else {column_name}::text end"
 
-        # get label centre and polygon
-        label_row["confidence"], label_row["latitude"], label_row["longitude"], \
-        label_row["point_geom"], label_row["geom"] = \
-            convert_label_to_polygon(latitude, longitude, label)
 
-        # get legal parcel identifier & address ID (gnaf_pid) if using reference data
-        if use_reference_data:
-            label_row["legal_parcel_id"], label_row["gnaf_pid"], label_row["address"] = \
-                get_parcel_and_address_ids(label_row["latitude"], label_row["longitude"])
+def get_grid_bounds():
+    """Gets the min/max coords of the grid of images - from the clip boundary if there is one"""
 
-        # insert into postgres
-        insert_row(label_table,  label_row)
+    if clip_boundary_path is not None:
+        return list(get_clip_boundary().bounds)
 
+    return [input_x_min, input_y_min, input_x_max, input_y_max]
 
-def import_image_to_postgres(latitude, longitude):
-    """Inserts an image's polygon & metadata into the database"""
 
-    # TODO: come up with a more meaningful ID for linking images with labels
-    image_path = f"image_{latitude}_{longitude}.jpg"
+def get_clip_boundary():
+    """Loads the boundary to create the grid in from a GeoJSON (geometry, feature or feature collection) or WKT file"""
 
-    # import image bounds as polygons for reference
-    x_max = longitude + width
-    y_min = latitude - height
+    with open(clip_boundary_path, "r") as boundary_file:
+        boundary_text = boundary_file.read().strip()
 
-    image_row = dict()
-    image_row["file_path"] = image_path
-    # image_row["label_count"] = label_count
-    image_row["width"] = width
-    image_row["height"] = width
-    image_row["geom"] = make_wkt_polygon(longitude, y_min, x_max, latitude)
-    insert_row(image_table,  image_row)
+    if boundary_text.startswith("{"):
+        geojson = json.loads(boundary_text)
 
+        if geojson.get("type") == "FeatureCollection":
+            geometries = [feature["geometry"] for feature in geojson["features"]]
+        elif geojson.get("type") == "Feature":
+            geometries = [geojson["geometry"]]
+        else:
+            geometries = [geojson]
 
-if __name__ == "__main__":
-    # setup logging
-    logger = logging.getLogger()
+        boundary = shapely.union_all([shapely.from_geojson(json.dumps(geometry)) for geometry in geometries])
+    else:
+        boundary = shapely.from_wkt(boundary_text)
 
-    # set logger
-    log_file = os.path.abspath(__file__).replace(".py", ".log")
-    logging.basicConfig(filename=log_file, level=logging.DEBUG, format="%(asctime)s %(message)s",
-                        datefmt="%m/%d/%Y %I:%M:%S %p")
+    # speeds up checking which images touch the boundary
+    shapely.prepare(boundary)
 
-    # setup logger to write to screen as well as writing to log file
-    # define a Handler which writes INFO messages or higher to the sys.stderr
-    console = logging.StreamHandler()
-    console.setLevel(logging.INFO)
-    # set a format which is simpler for console use
-    formatter = logging.Formatter("%(name)-12s: %(levelname)-8s %(message)s")
-    # tell the handler to use this format
-    console.setFormatter(formatter)
-    # add the handler to the root logger
-    logging.getLogger("").addHandler(console)
+    return boundary
+
+
+def get_grid_coords(grid_bounds):
+    """Generates the top/left lat/longs of the images in a grid, a row of images at a time (or a row of super tiles).
+       Coords are calculated from their row & column number (not by adding up distances, which drifts as rounding
+       errors add up) and rounded to 7 decimal places (~1cm) to keep image IDs tidy"""
+
+    x_min, y_min, x_max, y_max = grid_bounds
+
+    boundary = None
+    if clip_boundary_path is not None:
+        boundary = get_clip_boundary()
+
+    row_count = math.ceil((y_max - y_min) / y_stride)
+    column_count = math.ceil((x_max - x_min) / x_stride)
+
+    # super tiles: generate a row of super tiles at a time, a super tile at a time
+    band_size = super_tile_size if use_super_tiles() else 1
+
+    for first_row in range(0, row_count, band_size):
+        rows, columns = numpy.meshgrid(numpy.arange(first_row, min(first_row + band_size, row_count)),
+                                       numpy.arange(column_count), indexing="ij")
+        rows = rows.ravel()
+        columns = columns.ravel()
+
+        order = numpy.lexsort((columns, rows, columns // band_size))
+
+        latitudes = numpy.round(y_max - rows[order] * y_stride, 7)
+        longitudes = numpy.round(x_min + columns[order] * x_stride, 7)
+
+        if boundary is not None:
+            touching = shapely.intersects(boundary, shapely.box(longitudes, latitudes - height,
+                                                                longitudes + width, latitudes))
+            latitudes = latitudes[touching]
+            longitudes = longitudes[touching]
+
+        for latitude, longitude in zip(latitudes.tolist(), longitudes.tolist()):
+            yield [latitude, longitude]
+
+
+def use_super_tiles():
+    """Are images downloaded from the WMS as super tiles?"""
+
+    return imagery_source == "wms" and super_tile_size > 1
+
+
+def use_label_merge():
+    """Are labels in overlapping images merged?"""
+
+    return tile_stride_pixels < image_width
+
+
+def set_grid_origin(job_list):
+    """Sets the top left of the grid of images (the top left of the job list)"""
+
+    global grid_origin
+
+    if len(job_list) > 0:
+        grid_origin = [max([coords[0] for coords in job_list]), min([coords[1] for coords in job_list])]
+
+
+def get_grid_position(coords):
+    """Gets the row & column of an image in the grid of images"""
+
+    return round((grid_origin[0] - coords[0]) / y_stride), round((coords[1] - grid_origin[1]) / x_stride)
+
+
+def get_super_tile_position(coords):
+    """Gets the row & column of an image's super tile in the super tile grid; and the image's row & column within it"""
+
+    row, column = get_grid_position(coords)
+
+    super_row, row = divmod(row, super_tile_size)
+    super_column, column = divmod(column, super_tile_size)
+
+    return super_row, super_column, row, column
+
+
+def group_jobs_by_super_tile(job_group):
+    """Groups a job group's images into super tiles. Returns the top left lat/long of each super tile
+       and its images' coords & row/column within it"""
+
+    super_tiles = dict()
+
+    for coords in job_group:
+        super_row, super_column, row, column = get_super_tile_position(coords)
+
+        if (super_row, super_column) not in super_tiles:
+            super_tile = dict()
+            super_tile["latitude"] = grid_origin[0] - super_row * super_tile_size * y_stride
+            super_tile["longitude"] = grid_origin[1] + super_column * super_tile_size * x_stride
+            super_tile["images"] = list()
+            super_tiles[(super_row, super_column)] = super_tile
+
+        super_tiles[(super_row, super_column)]["images"].append([coords, row, column])
+
+    return list(super_tiles.values())
+
+
+def split_list(lst, n):
+    """Yield successive n-sized chunks from lst (any iterable - lists or generators)."""
+    iterator = iter(lst)
+    chunk = list(itertools.islice(iterator, n))
+    while len(chunk) > 0:
+        yield chunk
+        chunk = list(itertools.islice(iterator, n))
+
+
+def get_labels_on_all_devices(job_groups):
+    """Runs one labelling process per device, each with its own copy of the model.
+       The processes share one queue of job groups, so faster devices take more of the work"""
+
+    # required for torch multiprocessing on GPUs
+    mp_context = torch.multiprocessing.get_context("spawn")
+
+    work_queue = mp_context.Queue(maxsize=len(inference_devices) * 2)
+    result_queue = mp_context.Queue()
+
+    # overlapping images: labels from all processes are merged in this process (in a background thread)
+    merge_queue = None
+    merge_result = dict()
+    if use_label_merge():
+        merge_queue = mp_context.Queue(maxsize=len(inference_devices) * 4)
+        merge_thread = threading.Thread(target=run_label_merge, args=(merge_queue, merge_result), daemon=True)
+        merge_thread.start()
+
+    # processes start with the settings in this script - pass on any that have been changed since
+    process_settings = dict()
+    process_settings["cpu_thread_count"] = cpu_thread_count
+    process_settings["image_limit"] = image_limit
+    process_settings["inference_devices"] = inference_devices
+    process_settings["max_concurrent_downloads"] = max_concurrent_downloads
+    process_settings["grid_origin"] = grid_origin
+    process_settings["worker_name"] = worker_name
+    process_settings["fence_batch_writes"] = fence_batch_writes
+
+    processes = list()
+    for device_tag in inference_devices:
+        process = mp_context.Process(target=run_labelling_process,
+                                     args=(device_tag, process_settings, work_queue, result_queue, merge_queue))
+        process.start()
+        processes.append(process)
+
+    # share out the work, then tell each process there's no more to do
+    for job_group in itertools.chain(job_groups, [None] * len(processes)):
+        while True:
+            try:
+                work_queue.put(job_group, timeout=60)
+                break
+            except queue.Full:
+                if not any([process.is_alive() for process in processes]):
+                    raise Exception("all labelling processes have stopped")
+
+    # aggregate the results (a process that died won't return any - its images will be pending in the run ledger)
+    total_label_count = 0
+    total_image_fail_count = 0
+    result_count = 0
+
+    while result_count < len(processes):
+        try:
+            label_count, image_fail_count, process_metrics = result_queue.get(timeout=60)
+        except queue.Empty:
+            if not any([process.is_alive() for process in processes]):
+                logger.warning(f"\t - {len(processes) - result_count} labelling processes FAILED")
+                break
+            continue
+
+        total_label_count += label_count
+        total_image_fail_count += image_fail_count
+        result_count += 1
+
+        merge_run_metrics(process_metrics)
+
+    for process in processes:
+        process.join()
+
+    # finish merging labels (the processes' label counts are before merging)
+    if merge_queue is not None:
+        merge_queue.put(None)
+        merge_thread.join()
+        total_label_count = merge_result["label_count"]
+
+    return total_label_count, total_image_fail_count
+
+
+def run_labelling_process(device_tag, process_settings, work_queue, result_queue, merge_queue):
+    """Labels job groups from the shared work queue on one device until told there's no more work"""
+
+    global label_merge_queue
+    global cpu_thread_count
+    global image_limit
+    global inference_devices
+    global max_concurrent_downloads
+    global grid_origin
+    global worker_name
+    global fence_batch_writes
+    global pg_pool
+
+    setup_logging()
+
+    # create this process's postgres connection pool
+    pg_pool = psycopg2.pool.ThreadedConnectionPool(1, max_postgres_connections, pg_connect_string)
+
+    cpu_thread_count = process_settings["cpu_thread_count"]
+    image_limit = process_settings["image_limit"]
+    inference_devices = process_settings["inference_devices"]
+    max_concurrent_downloads = process_settings["max_concurrent_downloads"]
+    grid_origin = process_settings["grid_origin"]
+    worker_name = process_settings["worker_name"]
+    fence_batch_writes = process_settings["fence_batch_writes"]
+    label_merge_queue = merge_queue
+
+    label_count, image_fail_count = get_labels(device_tag, iter(work_queue.get, None))
+
+    # send this process's results & run metrics to the main process
+    result_queue.put([label_count, image_fail_count, run_metrics])
+
+
+def get_labels(device_tag, job_groups):
+    """Downloads images asynchronously & in parallel (in a background thread) and runs them through the model to detect
+       pools as they arrive. Downloads & inference overlap; the image queue depth caps how far downloads can get ahead"""
 
-    main()
+    # load trained model to run on selected GPU (or CPUs)
+    device = torch.device(device_tag)
+    model = load_model(device)
+
+    # CPU processes only use their share of the cores
+    if device.type == "cpu" and cpu_thread_count is not None:
+        torch.set_num_threads(cpu_thread_count)
+
+    # overlapping images: merge labels found in more than one image in this process (if it's the only one)
+    if use_label_merge() and label_merge_queue is None:
+        start_label_merge()
+
+    # copy buffered rows into Postgres in the background (keeps database writes off the download event loop)
+    start_row_writer()
+
+    # start downloading images into a bounded queue, asynchronously in parallel
+    image_queue = queue.Queue(maxsize=image_queue_depth)
+    download_thread = threading.Thread(target=download_images, args=(job_groups, image_queue), daemon=True)
+    download_thread.start()
+
+    total_image_fail_count = 0
+    total_label_count = 0
+    i = 0
+
+    # starting batch size (adjusted after each batch based on memory used)
+    batch_size = image_limit
+
+    # detect labels on batches of images as they come off the queue
+    while True:
+        start_time = datetime.now()
+
+        image_download_list = get_image_batch(image_queue, batch_size)
+        if len(image_download_list) == 0:
+            break
+
+        i += len(image_download_list)
+
+        # get rid of image download failures and count them
+        coords_list = list()
+        image_list = list()
+        failed_coords_list = list()
+        for coords, image_data in image_download_list:
+            if image_data is not None:
+                coords_list.append(coords)
+                image_list.append(image_data)
+            else:
+                failed_coords_list.append(coords)
+
+        total_image_fail_count += len(failed_coords_list)
+
+        if len(image_list) == 0:
+            # overlapping images: stop held back labels waiting on the failed images (they won't have any labels)
+            if use_label_merge():
+                import_labels_to_postgres(list(), list(), failed_coords_list)
+            continue
+
+        record_histogram_value("batch_images", len(image_list), depth_buckets)
+
+        # run inference (on the images that get through the pool filter, if using it)
+        if pool_filter_min_fraction is None or pool_filter_stats["turned_off"]:
+            tensor_labels, batch_size = run_model(model, device, image_list, batch_size)
+        else:
+            tensor_labels, batch_size = run_model_on_filtered_images(model, device, image_list, batch_size)
+
+        # logger.info(f"\t - {device_tag} : group {i} of {job_count} : pool detection done : {datetime.now() - start_time}")
+        # start_time = datetime.now()
+
+        # export the whole batch of results to the database
+        total_label_count += import_labels_to_postgres(tensor_labels, coords_list, failed_coords_list)
+
+        # record the images as done in the run ledger (committed with their labels)
+        # note: if images overlap, images are only recorded as done once all their labels held back for merging have
+        # been saved (see import_merged_label_rows())
+        if not use_label_merge():
+            for coords in coords_list:
+                set_tile_state(coords[0], coords[1], "inferred")
+
+        logger.info(f"\t - {device_tag} : {i} images : done : {datetime.now() - start_time} : {total_label_count} total labels detected")
+
+    download_thread.join()
+
+    if pool_filter_min_fraction is not None:
+        log_pool_filter_stats(device_tag)
+
+        for name in ["image_count", "skipped_image_count", "audit_image_count", "audit_pool_image_count"]:
+            count_metric(f"pool_filter_{name}", pool_filter_stats[name])
+
+    record_memory_use(device_tag, device)
+
+    # save the labels still held back for merging
+    if label_merge is not None:
+        total_label_count += import_merged_label_rows(finish_label_merge())
+
+    # copy any remaining labels & images into Postgres
+    stop_row_writer()
+    flush_rows()
+
+    return total_label_count, total_image_fail_count
+
+
+def run_model_on_filtered_images(model, device, image_list, batch_size):
+    """Runs the model on the images that get through the pool filter (plus the audit sample of the rest). Images that
+       are skipped get no labels. Returns the labels for each image & the batch size to use next"""
+
+    model_indexes, audit_indexes = filter_images(image_list)
+
+    tensor_labels = [torch.zeros((0, 6), device=device) for _ in image_list]
+
+    if len(model_indexes) > 0:
+        model_tensor_labels, batch_size = run_model(model, device, [image_list[i] for i in model_indexes], batch_size)
+
+        for i, tensor_label in zip(model_indexes, model_tensor_labels):
+            tensor_labels[i] = tensor_label
+
+    check_pool_filter_audit([tensor_labels[i] for i in audit_indexes])
+
+    return tensor_labels, batch_size
+
+
+def filter_images(image_list):
+    """Picks the images to run the model on: the ones with enough pool coloured pixels, plus a random sample of the rest
+       (the audit sample - used to measure how many images with pools the filter skips).
+       Returns the indexes of the images to run the model on & the indexes of the audit sample"""
+
+    model_indexes = list()
+    audit_indexes = list()
+
+    for i, image_data in enumerate(image_list):
+        if get_pool_colour_fraction(image_data) >= pool_filter_min_fraction:
+            model_indexes.append(i)
+        elif random.random() < pool_filter_audit_rate:
+            model_indexes.append(i)
+            audit_indexes.append(i)
+
+    pool_filter_stats["image_count"] += len(image_list)
+    pool_filter_stats["skipped_image_count"] += len(image_list) - len(model_indexes)
+    pool_filter_stats["audit_image_count"] += len(audit_indexes)
+
+    return model_indexes, audit_indexes
+
+
+def get_pool_colour_fraction(image_data):
+    """Gets the fraction of an image's pixels that are pool coloured (blue/cyan water) from a thumbnail of the image.
+       JPEGs are only partly decoded (at 1/8 size); image arrays are subsampled without copying"""
+
+    if isinstance(image_data, numpy.ndarray):
+        step = max(image_data.shape[1] // pool_filter_thumbnail_size, 1)
+        thumbnail = numpy.moveaxis(image_data[:, ::step, ::step], 0, -1)
+    else:
+        image = Image.open(io.BytesIO(image_data))
+        image.draft("RGB", (pool_filter_thumbnail_size, pool_filter_thumbnail_size))
+        image = image.convert("RGB")
+        if image.width > pool_filter_thumbnail_size * 2:
+            image = image.reduce(image.width // pool_filter_thumbnail_size)
+        thumbnail = numpy.asarray(image)
+
+    return get_pool_colour_mask(thumbnail).mean()
+
+
+def get_pool_colour_mask(rgb_pixels):
+    """Flags the pixels in an array of RGB pixels (uint8, any shape ending in 3 channels) that are pool coloured;
+       using their hue, saturation & value (HSV)"""
+
+    rgb_pixels = rgb_pixels.astype(numpy.float32) / 255.0
+    red = rgb_pixels[..., 0]
+    green = rgb_pixels[..., 1]
+    blue = rgb_pixels[..., 2]
+
+    value = rgb_pixels.max(axis=-1)
+    chroma = value - rgb_pixels.min(axis=-1)
+    saturation = chroma / numpy.maximum(value, 1e-6)
+
+    # hue in degrees, based on which colour is brightest (greys have no hue - they aren't pool coloured anyway)
+    safe_chroma = numpy.maximum(chroma, 1e-6)
+    hue = numpy.select([value == red, value == green],
+                       [60.0 * (((green - blue) / safe_chroma) % 6.0), 60.0 * ((blue - red) / safe_chroma + 2.0)],
+                       60.0 * ((red - green) / safe_chroma + 4.0))
+
+    return ((hue >= pool_hue_range[0]) & (hue <= pool_hue_range[1])
+            & (saturation >= pool_min_saturation) & (value >= pool_min_value))
+
+
+def check_pool_filter_audit(audit_tensor_labels):
+    """Counts the audited images (ones the filter would have skipped) that have pools. If too many have pools the
+       filter is turned off for the rest of the run (the recall safeguard)"""
+
+    pool_filter_stats["audit_pool_image_count"] += len([True for tensor_label in audit_tensor_labels
+                                                        if len(tensor_label) > 0])
+
+    audit_image_count = pool_filter_stats["audit_image_count"]
+    if pool_filter_stats["turned_off"] or audit_image_count < pool_filter_min_audit_count:
+        return
+
+    miss_rate = pool_filter_stats["audit_pool_image_count"] / audit_image_count
+    if miss_rate > pool_filter_max_miss_rate:
+        pool_filter_stats["turned_off"] = True
+        logger.warning(f"\t - pool filter turned off : {miss_rate:.1%} of the skipped images audited have pools "
+                       f"(max is {pool_filter_max_miss_rate:.1%})")
+
+
+def log_pool_filter_stats(device_tag):
+    """Logs how many images the pool filter skipped & the estimated number of skipped images with pools"""
+
+    image_count = max(pool_filter_stats["image_count"], 1)
+    skipped_image_count = pool_filter_stats["skipped_image_count"]
+    audit_image_count = pool_filter_stats["audit_image_count"]
+    audit_pool_image_count = pool_filter_stats["audit_pool_image_count"]
+
+    # the images skipped with pools, estimated from the audit sample
+    missed_image_count = 0
+    if audit_image_count > 0:
+        missed_image_count = round(skipped_image_count * audit_pool_image_count / audit_image_count)
+
+    logger.info(f"\t - {device_tag} : pool filter : {skipped_image_count} of {pool_filter_stats['image_count']} images "
+                f"skipped ({skipped_image_count / image_count:.1%}) : {audit_pool_image_count} of {audit_image_count} "
+                f"audited images have pools : ~{missed_image_count} skipped images with pools")
+
+
+def load_model(device):
+    """Loads the trained model onto a GPU (or the CPU); or an exported copy of it, depending on the inference backend.
+       Exported models are returned as a dictionary of the backend, the loaded model & whether it's fp16"""
+
+    if inference_precision not in ["fp32", "fp16", "int8"]:
+        raise Exception(f"unknown inference precision '{inference_precision}'")
+    if inference_precision == "fp16" and (device.type != "cuda" or inference_backend == "onnx"):
+        raise Exception("fp16 precision is only supported on GPUs by the pytorch & torchscript backends")
+    if inference_precision == "int8" and (device.type != "cpu" or inference_backend != "onnx"):
+        raise Exception("int8 precision is only supported on CPUs by the onnx backend")
+
+    use_fp16 = inference_precision == "fp16"
+
+    if inference_backend == "pytorch":
+        model = torch.hub.load(yolo_home, "custom", path=model_path, source="local")
+        model.to(device)
+
+        if use_fp16:
+            model.half()
+            model.model.fp16 = True
+
+        return model
+
+    elif inference_backend == "torchscript":
+        module = torch.jit.load(get_exported_model_path(), map_location=device)
+        module.eval()
+
+        if use_fp16:
+            module.half()
+
+        return {"backend": inference_backend, "module": module, "fp16": use_fp16}
+
+    elif inference_backend == "onnx":
+        # ONNX Runtime is only needed for this backend
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        if device.type == "cpu" and cpu_thread_count is not None:
+            session_options.intra_op_num_threads = cpu_thread_count
+
+        if device.type == "cuda":
+            providers = [("CUDAExecutionProvider", {"device_id": device.index or 0})]
+        else:
+            providers = ["CPUExecutionProvider"]
+
+        session = onnxruntime.InferenceSession(get_exported_model_path(), sess_options=session_options,
+                                               providers=providers)
+
+        return {"backend": inference_backend, "session": session, "input_name": session.get_inputs()[0].name,
+                "fp16": use_fp16}
+
+    else:
+        raise Exception(f"unknown inference backend '{inference_backend}'")
+
+
+def get_exported_model_path():
+    """Gets the path of the exported model for the inference backend & precision (next to the trained model)"""
+
+    base_path = os.path.splitext(model_path)[0]
+
+    if inference_backend == "torchscript":
+        return f"{base_path}.torchscript"
+    elif inference_precision == "int8":
+        return f"{base_path}_int8.onnx"
+    else:
+        return f"{base_path}.onnx"
+
+
+def run_model(model, device, image_list, batch_size):
+    """Runs the model on a batch of images. Returns the labels for each image & the batch size to use next.
+       The next batch size is based on this batch's peak memory use per image (vs. the memory budget).
+       If the device runs out of memory - the batch is split in half and each half is retried"""
+
+    memory_before = get_memory_used(device)
+    reset_peak_memory_used(device)
+
+    try:
+        tensor_labels = detect_pools(model, device, image_list)
+    except (RuntimeError, MemoryError) as ex:
+        if not is_out_of_memory_error(ex) or len(image_list) == 1:
+            raise
+
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+        half_count = math.ceil(len(image_list) / 2)
+        logger.warning(f"\t - {device} : ran out of memory on {len(image_list)} images : retrying in 2 batches")
+
+        first_tensor_labels, _ = run_model(model, device, image_list[:half_count], half_count)
+        second_tensor_labels, _ = run_model(model, device, image_list[half_count:], half_count)
+
+        # don't try a batch this big again until memory use has been measured on a smaller one
+        return first_tensor_labels + second_tensor_labels, max(math.floor(half_count / 2), 1)
+
+    memory_peak = get_peak_memory_used(device)
+
+    # get the number of images that fit in the budget (allowing 20% headroom for spikes), growing by 2x at most
+    # note: CPU processes share the budget (they share the machine's RAM)
+    memory_budget = memory_budget_gb * 1024 ** 3 * 0.8
+    batch_size_limit = max_image_limit
+
+    if device.type == "cpu":
+        if inference_devices is not None:
+            memory_budget /= max(inference_devices.count("cpu"), 1)
+        batch_size_limit = image_limit
+
+    memory_per_image = max(memory_peak - memory_before, 1) / len(image_list)
+    fitting_image_count = math.floor((memory_budget - memory_before) / memory_per_image)
+
+    next_batch_size = max(min(fitting_image_count, batch_size * 2, batch_size_limit), 1)
+
+    return tensor_labels, next_batch_size
+
+
+def detect_pools(model, device, image_list):
+    """Runs the model on a list of images (as raw JPEG/PNG bytes or (3, height, width) uint8 arrays) and returns the labels for each image as a tensor of
+       pixel coords, confidence & class - [left, top, right, bottom, confidence, class]"""
+
+    if inference_backend != "pytorch":
+        return detect_pools_with_exported_model(model, device, image_list)
+
+    if not fast_preprocessing:
+        # let YOLOv5 convert, letterbox & copy each image (image arrays need to be height, width, channels)
+        # note: decoding is done by the model, so it's included in the inference time
+        inference_start_time = time.perf_counter()
+        results = model([numpy.moveaxis(image_data, 0, -1) if isinstance(image_data, numpy.ndarray)
+                         else Image.open(io.BytesIO(image_data)) for image_data in image_list])
+        record_timing("inference_seconds", time.perf_counter() - inference_start_time)
+
+        # DEBUG: save labelled images
+        # results.save(os.path.join(script_dir, "output"))
+
+        return results.xyxy
+
+    # YOLOv5 code (it's on the path once the model has been loaded)
+    from utils.general import non_max_suppression
+
+    decode_start_time = time.perf_counter()
+    image_batch = get_image_batch_tensor(image_list, device)
+    record_timing("decode_seconds", time.perf_counter() - decode_start_time)
+
+    inference_start_time = time.perf_counter()
+
+    # run the model directly - skipping YOLOv5's AutoShape wrapper - then apply its non-maximum suppression
+    detection_model = model.model
+    if detection_model.fp16:
+        image_batch = image_batch.half()
+    else:
+        image_batch = image_batch.float()
+    image_batch /= 255.0
+
+    with torch.no_grad():
+        predictions = detection_model(image_batch)
+
+    if isinstance(predictions, (list, tuple)):
+        predictions = predictions[0]
+
+    tensor_labels = non_max_suppression(predictions, model.conf, model.iou, classes=model.classes,
+                                        agnostic=model.agnostic, multi_label=model.multi_label, max_det=model.max_det)
+    record_timing("inference_seconds", time.perf_counter() - inference_start_time)
+
+    return tensor_labels
+
+
+def detect_pools_with_exported_model(model, device, image_list):
+    """Runs an exported (TorchScript or ONNX) model on a list of images & returns the labels for each image (the same as
+       detect_pools() does). Doesn't need the YOLOv5 code"""
+
+    decode_start_time = time.perf_counter()
+    image_batch = get_image_batch_tensor(image_list, device)
+    record_timing("decode_seconds", time.perf_counter() - decode_start_time)
+
+    inference_start_time = time.perf_counter()
+
+    if model["fp16"]:
+        image_batch = image_batch.half()
+    else:
+        image_batch = image_batch.float()
+    image_batch /= 255.0
+
+    if model["backend"] == "torchscript":
+        with torch.no_grad():
+            predictions = model["module"](image_batch)
+
+        if isinstance(predictions, (list, tuple)):
+            predictions = predictions[0]
+    else:
+        predictions = model["session"].run(None, {model["input_name"]: image_batch.cpu().numpy()})[0]
+        predictions = torch.from_numpy(predictions).to(device)
+
+    tensor_labels = get_labels_from_predictions(predictions.float())
+    record_timing("inference_seconds", time.perf_counter() - inference_start_time)
+
+    return tensor_labels
+
+
+def get_labels_from_predictions(predictions):
+    """Turns an exported model's raw predictions - (images, candidates, [x centre, y centre, width, height, objectness,
+       class scores...]) in pixels - into labels for each image: [left, top, right, bottom, confidence, class].
+       Uses the same confidence threshold & non-maximum suppression (NMS) as YOLOv5"""
+
+    tensor_labels = list()
+
+    for image_predictions in predictions:
+        # confidence = objectness x class score
+        class_scores = image_predictions[:, 5:] * image_predictions[:, 4:5]
+        confidences, classes = class_scores.max(dim=1)
+
+        confident = confidences > label_confidence_threshold
+        boxes = torchvision.ops.box_convert(image_predictions[confident, :4], "cxcywh", "xyxy")
+        confidences = confidences[confident]
+        classes = classes[confident]
+
+        # remove labels that overlap a more confident label of the same class
+        kept = torchvision.ops.batched_nms(boxes, confidences, classes, label_iou_threshold)[:max_labels_per_image]
+
+        tensor_labels.append(torch.cat([boxes[kept], confidences[kept, None], classes[kept, None].float()], dim=1))
+
+    return tensor_labels
+
+
+def get_image_batch_tensor(image_list, device):
+    """Decodes a list of JPEG/PNG images (or copies image arrays) straight into a reused (pinned memory if using a GPU) uint8 tensor batch of shape
+       (images, 3, height, width); and copies it to the device. The buffer only grows when a bigger batch comes along"""
+
+    global image_batch_buffer
+
+    if image_batch_buffer is None or image_batch_buffer.shape[0] < len(image_list):
+        image_batch_buffer = torch.empty((len(image_list), 3, image_height, image_width), dtype=torch.uint8)
+        if torch.cuda.is_available():
+            image_batch_buffer = image_batch_buffer.pin_memory()
+
+    image_batch = image_batch_buffer[:len(image_list)]
+
+    for i, image_data in enumerate(image_list):
+        if isinstance(image_data, numpy.ndarray):
+            image_batch[i].copy_(torch.from_numpy(image_data))
+        else:
+            image_bytes = torch.frombuffer(bytearray(image_data), dtype=torch.uint8)
+            image_batch[i].copy_(torchvision.io.decode_image(image_bytes, mode=torchvision.io.ImageReadMode.RGB))
+
+    return image_batch.to(device, non_blocking=True)
+
+
+def get_memory_used(device):
+    """Gets the memory currently used on a GPU; or for CPUs, the memory (RSS) used by this process"""
+
+    if device.type == "cuda":
+        return torch.cuda.memory_allocated(device)
+
+    try:
+        with open("/proc/self/statm", "r") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except FileNotFoundError:
+        # MacOS - no /proc, so use the peak RSS instead (which is in bytes on MacOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_memory_used(device):
+    """Resets the peak memory use of a GPU; or for CPUs, the peak RSS of this process (Linux only - on other OSes the
+       peak is for the life of the process, which overestimates the memory used by a batch)"""
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+
+    # keep the peak RSS so far for the run report (resetting VmHWM also resets getrusage()'s peak RSS)
+    global peak_rss_bytes
+    peak_rss_bytes = max(peak_rss_bytes, get_peak_memory_used(device))
+
+    try:
+        # resets the process's peak RSS (VmHWM) to its current RSS
+        with open("/proc/self/clear_refs", "w") as clear_refs_file:
+            clear_refs_file.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_memory_used(device):
+    """Gets the peak memory used on a GPU; or for CPUs, the peak RSS of this process, since the last reset.
+       Measured the same way as get_memory_used() - i.e. memory allocated to tensors on GPUs (not cached memory)"""
+
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+
+    try:
+        with open("/proc/self/status", "r") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+
+    # MacOS - no /proc, so use the peak RSS for the life of the process (which is in bytes on MacOS)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def is_out_of_memory_error(ex):
+    """Is the error a GPU or CPU out of memory error?"""
+
+    if isinstance(ex, MemoryError):
+        return True
+
+    message = str(ex).lower()
+
+    return "out of memory" in message or "not enough memory" in message or "can't allocate memory" in message
+
+
+def get_image_batch(image_queue, batch_size):
+    """Waits for the next downloaded image and then takes whatever else is ready off the queue (up to the batch size).
+       Returns an empty list once all images have been downloaded.
+       Buffered rows are copied into Postgres while waiting (so they aren't held back while there's nothing to do)"""
+
+    image_download_list = list()
+
+    # record how far downloads are ahead of the model (a queue that's always empty means the model is waiting on them)
+    record_histogram_value("image_queue_depth", image_queue.qsize(), depth_buckets)
+    if download_limiter is not None:
+        record_histogram_value("downloads_in_flight", download_limiter["active"], depth_buckets)
+
+    wait_start_time = time.perf_counter()
+
+    while True:
+        try:
+            image_download = image_queue.get(timeout=postgres_flush_seconds)
+            break
+        except queue.Empty:
+            flush_rows()
+
+    record_timing("image_wait_seconds", time.perf_counter() - wait_start_time)
+
+    while image_download is not end_of_images:
+        image_download_list.append(image_download)
+
+        if len(image_download_list) >= batch_size:
+            break
+
+        try:
+            image_download = image_queue.get_nowait()
+        except queue.Empty:
+            break
+
+    # put the end marker back for the next call
+    if image_download is end_of_images:
+        image_queue.put(end_of_images)
+
+    return image_download_list
+
+
+def download_images(job_groups, image_queue):
+    """Runs the asynchronous image downloads in their own event loop (in a background thread).
+       Always finishes by putting the end marker on the queue, even if the downloads fail"""
+
+    connection_stats = dict()
+    connection_stats["requests"] = 0
+    connection_stats["new_connections"] = 0
+    connection_stats["reused_connections"] = 0
+    connection_stats["dns_lookups"] = 0
+    connection_stats["retries"] = 0
+    connection_stats["hedged_requests"] = 0
+
+    try:
+        asyncio.run(async_get_images(job_groups, image_queue, connection_stats))
+    except Exception as ex:
+        logger.warning(f"Image downloads FAILED: {ex}")
+    finally:
+        image_queue.put(end_of_images)
+
+    for name, count in connection_stats.items():
+        count_metric(f"wms_{name}", count)
+
+    # show how well HTTP connections were reused (images from the tile cache don't make requests)
+    if connection_stats["requests"] > 0:
+        reuse_percent = connection_stats["reused_connections"] / connection_stats["requests"] * 100.0
+        logger.info(f"\t - {connection_stats['requests']} WMS requests : "
+                    f"{connection_stats['new_connections']} connections opened : "
+                    f"{connection_stats['reused_connections']} reused ({reuse_percent:.1f}%) : "
+                    f"{connection_stats['dns_lookups']} DNS lookups")
+        logger.info(f"\t - {connection_stats['retries']} retries : "
+                    f"{connection_stats['hedged_requests']} hedged requests : "
+                    f"final download limit of {math.floor(download_limiter['limit'])}")
+
+
+async def async_get_images(job_groups, image_queue, connection_stats):
+    """Sets up the asynchronous downloading of images in parallel; putting each image on the queue as it arrives.
+       Only starts new downloads when there's a free slot, so a full queue pauses downloading.
+       One session (and its pool of keep-alive connections) is used for all job groups.
+       The number of requests in flight is adjusted to what the WMS can handle by the download limiter"""
+
+    global download_limiter
+    global download_stats
+
+    max_download_limit = max_concurrent_downloads * max_download_limit_factor
+
+    download_limiter = dict()
+    download_limiter["limit"] = float(max_concurrent_downloads)
+    download_limiter["max_limit"] = max_download_limit
+    download_limiter["active"] = 0
+    download_limiter["last_decrease"] = 0.0
+    download_limiter["condition"] = asyncio.Condition()
+
+    download_stats = connection_stats
+
+    conn = aiohttp.TCPConnector(limit=max_download_limit, limit_per_host=max_download_limit,
+                                keepalive_timeout=http_keepalive_seconds, ttl_dns_cache=http_dns_cache_seconds)
+    download_slots = asyncio.Semaphore(max_download_limit)
+
+    async with aiohttp.ClientSession(connector=conn, trust_env=True,
+                                     trace_configs=[get_connection_trace_config(connection_stats)]) as session:
+        process_list = []
+
+        # get each job group in a thread - they can come from the database (or wait for a batch to be claimed)
+        job_group_iterator = iter(job_groups)
+
+        while True:
+            job_group = await asyncio.to_thread(next, job_group_iterator, None)
+            if job_group is None:
+                break
+
+            if use_super_tiles():
+                for super_tile in group_jobs_by_super_tile(job_group):
+                    await download_slots.acquire()
+                    process_list.append(asyncio.create_task(
+                        queue_super_tile_images(session, super_tile, image_queue, download_slots)))
+            else:
+                for coords in job_group:
+                    await download_slots.acquire()
+                    process_list.append(asyncio.create_task(queue_image(session, coords, image_queue, download_slots)))
+
+            # forget finished downloads to keep the task list short
+            process_list = [process for process in process_list if not process.done()]
+
+        await asyncio.gather(*process_list)
+
+
+def get_connection_trace_config(connection_stats):
+    """Counts HTTP requests, new & reused connections and DNS lookups (for checking connections are being reused)"""
+
+    async def on_request_start(session, trace_config_ctx, params):
+        connection_stats["requests"] += 1
+
+    async def on_connection_create_end(session, trace_config_ctx, params):
+        connection_stats["new_connections"] += 1
+
+    async def on_connection_reuseconn(session, trace_config_ctx, params):
+        connection_stats["reused_connections"] += 1
+
+    async def on_dns_resolvehost_end(session, trace_config_ctx, params):
+        connection_stats["dns_lookups"] += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+
+    return trace_config
+
+
+async def queue_image(session, coords, image_queue, download_slots):
+    """Downloads an image and puts it on the queue (with no image if the download failed); freeing the download slot once
+       queued"""
+
+    try:
+        image_download = await get_image(session, coords)
+
+        # a full queue blocks here without blocking the event loop
+        await asyncio.to_thread(image_queue.put, image_download)
+    finally:
+        download_slots.release()
+
+
+async def queue_super_tile_images(session, super_tile, image_queue, download_slots):
+    """Downloads a super tile and puts its images on the queue (with no images if the download failed);
+       freeing the download slot once queued"""
+
+    try:
+        for image_download in await get_super_tile_images(session, super_tile):
+            await asyncio.to_thread(image_queue.put, image_download)
+    finally:
+        download_slots.release()
+
+
+async def get_super_tile_images(session, super_tile):
+    """Downloads a super tile from the WMS and slices it into images. The images are (3, height, width) views of the
+       super tile's pixels (not copies). Each image has the same lat/long bounds it would have if downloaded on its own"""
+
+    try:
+        download_start_time = time.perf_counter()
+        image_bytes = await get_wms_image(session, super_tile["latitude"], super_tile["longitude"], super_tile_size)
+        record_timing("super_tile_download_seconds", time.perf_counter() - download_start_time)
+
+        # decode the whole super tile (in a thread as it's big enough to hold up other downloads)
+        decode_start_time = time.perf_counter()
+        super_tile_image = await asyncio.to_thread(
+            lambda: numpy.array(Image.open(io.BytesIO(image_bytes)).convert("RGB")))
+        record_timing("super_tile_decode_seconds", time.perf_counter() - decode_start_time)
+
+        super_tile_pixels = image_width + (super_tile_size - 1) * tile_stride_pixels
+        if super_tile_image.shape[:2] != (super_tile_pixels, super_tile_pixels):
+            raise Exception(f"super tile is {super_tile_image.shape[1]}x{super_tile_image.shape[0]} pixels")
+
+    except Exception as ex:
+        # retries used up or an error that won't go away by retrying
+        logger.warning(f"Super tile download {super_tile['latitude']}, {super_tile['longitude']} FAILED: {ex}")
+
+        for coords, _, _ in super_tile["images"]:
+            set_tile_state(coords[0], coords[1], "failed")
+
+        return [[coords, None] for coords, _, _ in super_tile["images"]]
+
+    image_downloads = list()
+
+    for coords, row, column in super_tile["images"]:
+        top = row * tile_stride_pixels
+        left = column * tile_stride_pixels
+        image_pixels = super_tile_image[top:top + image_height, left:left + image_width]
+
+        # export image polygon & metadata to Postgres
+        import_image_to_postgres(coords[0], coords[1])
+        set_tile_state(coords[0], coords[1], "downloaded")
+
+        image_downloads.append([coords, numpy.moveaxis(image_pixels, 2, 0)])
+
+    return image_downloads
+
+
+async def get_image(session, coords):
+    """Gets an image from the imagery source (the WMS, local GeoTIFFs or a directory of images), saves it's bounds
+       (as a polygon) to Postgres and returns its coords & the image; as raw (JPEG or PNG) bytes or a (3, height, width)
+       uint8 array (or None if it failed)
+
+       Note: map coords are top/left (normally bottom/left) to match pixel coordinate convention)"""
+
+    latitude = coords[0]
+    longitude = coords[1]
+
+    try:
+        download_start_time = time.perf_counter()
+
+        if imagery_source == "wms":
+            image_data = await get_wms_image(session, latitude, longitude)
+        elif imagery_source == "geotiff":
+            image_data = await asyncio.to_thread(read_geotiff_image, latitude, longitude)
+        elif imagery_source == "tiles":
+            image_data = await asyncio.to_thread(read_tile_dir_image, latitude, longitude)
+        else:
+            raise Exception(f"unknown imagery source '{imagery_source}'")
+
+        record_timing("download_seconds", time.perf_counter() - download_start_time)
+
+        # check it's a valid image of the right size (only reads the image header - it's decoded with its batch)
+        if isinstance(image_data, numpy.ndarray):
+            image_size = (image_data.shape[2], image_data.shape[1])
+        else:
+            image_size = Image.open(io.BytesIO(image_data)).size
+
+        if image_size != (image_width, image_height):
+            raise Exception(f"image is {image_size[0]}x{image_size[1]} pixels")
+
+        # export image polygon & metadata to Postgres
+        import_image_to_postgres(latitude, longitude)
+        set_tile_state(latitude, longitude, "downloaded")
+
+        return [latitude, longitude], image_data
+
+    except Exception as ex:
+        # retries used up or an error that won't go away by retrying
+        logger.warning(f"Image download {latitude}, {longitude} FAILED: {ex}")
+        set_tile_state(latitude, longitude, "failed")
+        return [latitude, longitude], None
+
+
+async def get_wms_image(session, latitude, longitude, image_count=1):
+    """Downloads an image from a Web Map service (WMS) service into memory (or gets it from the tile cache) and returns
+       the image's raw (JPEG) bytes. Image count is the number of (possibly overlapping) images across & down to get in
+       one image"""
+
+    # try:
+        # response = wms.getmap(
+        #     layers=["0"],
+        #     srs='EPSG:4326',
+        #     bbox=(longitude, latitude - height, longitude + width, latitude),
+        #     format="image/jpeg",
+        #     size=(image_width, image_height)
+        # )
+
+    # querystring parameters
+    params = dict()
+    params["service"] = "WMS"
+    params["request"] = "GetMap"
+    params["version"] = "1.3.0"
+    params["layers"] = 0
+    params["styles"] = ""
+    params["crs"] = "epsg:4326"
+    if image_count == 1:
+        bbox_width = width
+        bbox_height = height
+    else:
+        bbox_width = width + (image_count - 1) * x_stride
+        bbox_height = height + (image_count - 1) * y_stride
+
+    params["bbox"] = f"{longitude},{latitude - bbox_height},{longitude + bbox_width},{latitude}"
+    params["width"] = image_width + (image_count - 1) * tile_stride_pixels
+    params["height"] = image_height + (image_count - 1) * tile_stride_pixels
+    params["format"] = "image/jpeg"
+
+    # get image from the local tile cache if it's been downloaded before (file I/O is done off the event loop)
+    response = None
+    if tile_cache_dir is not None:
+        response = await asyncio.to_thread(read_tile_cache, params)
+
+    if response is None:
+        if tile_cache_only:
+            raise Exception("image not in tile cache")
+
+        # download image (retrying if it fails)
+        response = await download_image(session, params)
+
+        if tile_cache_dir is not None:
+            await asyncio.to_thread(write_tile_cache, params, response)
+
+    # DEBUG: save image to disk
+    # Image.open(io.BytesIO(response)).save(os.path.join(script_dir, "input", f"image_{latitude}_{longitude}.jpg"))
+
+    return response
+
+
+def read_geotiff_image(latitude, longitude):
+    """Reads an image from the GeoTIFF mosaic using windowed reads (only the file blocks under the image are read).
+       Images on the edge of 2 or more files are pieced together. Returns a (3, height, width) uint8 array"""
+
+    left = longitude
+    bottom = latitude - height
+    right = longitude + width
+    top = latitude
+
+    image_array = numpy.zeros((3, image_height, image_width), dtype=numpy.uint8)
+    file_count = 0
+
+    for file_path, bounds in get_geotiff_index():
+        if bounds.left >= right or bounds.right <= left or bounds.bottom >= top or bounds.top <= bottom:
+            continue
+
+        dataset = get_geotiff_dataset(file_path)
+        window = rasterio.windows.from_bounds(left, bottom, right, top, transform=dataset.transform)
+
+        # reads resample the file's pixels to the model's image size
+        if bounds.left <= left and bounds.right >= right and bounds.bottom <= bottom and bounds.top >= top:
+            image_array = dataset.read(indexes=[1, 2, 3], window=window, out_shape=(3, image_height, image_width),
+                                       resampling=rasterio.enums.Resampling.bilinear)
+            file_count = 1
+            break
+        else:
+            # image is partly off this file - only copy the pixels that are on it
+            file_data = dataset.read(indexes=[1, 2, 3], window=window, out_shape=(3, image_height, image_width),
+                                     resampling=rasterio.enums.Resampling.bilinear, boundless=True, masked=True)
+            on_file = ~numpy.ma.getmaskarray(file_data)
+            image_array[on_file] = file_data.data[on_file]
+            file_count += 1
+
+    if file_count == 0:
+        raise Exception("image is outside the GeoTIFF mosaic")
+
+    return image_array
+
+
+def get_geotiff_index():
+    """Gets the file path & bounds of each file in the GeoTIFF mosaic (checking they can be used as images)"""
+
+    global geotiff_index
+
+    with geotiff_index_lock:
+        if geotiff_index is None:
+            file_index = list()
+
+            for file_path in sorted(glob.glob(geotiff_path)):
+                with rasterio.open(file_path) as dataset:
+                    if dataset.crs is None or not dataset.crs.is_geographic:
+                        raise Exception(f"{file_path} isn't in lat/long coords")
+                    if dataset.count < 3 or dataset.dtypes[0] != "uint8":
+                        raise Exception(f"{file_path} isn't an 8 bit RGB image")
+
+                    file_index.append([file_path, dataset.bounds])
+
+            if len(file_index) == 0:
+                raise Exception(f"no GeoTIFFs found in {geotiff_path}")
+
+            geotiff_index = file_index
+
+    return geotiff_index
+
+
+def get_geotiff_dataset(file_path):
+    """Gets this thread's open copy of a GeoTIFF (files stay open for the run to avoid re-reading their headers)"""
+
+    if not hasattr(geotiff_thread_data, "datasets"):
+        geotiff_thread_data.datasets = dict()
+
+    if file_path not in geotiff_thread_data.datasets:
+        geotiff_thread_data.datasets[file_path] = rasterio.open(file_path)
+
+    return geotiff_thread_data.datasets[file_path]
+
+
+def read_tile_dir_image(latitude, longitude):
+    """Reads an image's raw bytes from the tile directory"""
+
+    with open(os.path.join(tile_dir, get_image_file_path(latitude, longitude)), "rb") as image_file:
+        return image_file.read()
+
+
+async def download_image(session, params):
+    """Downloads an image from the WMS; retrying errors that might not happen next time (server overloaded, timeouts,
+       dropped connections) after a random, exponentially growing wait (full jitter - to stop retries bunching up)"""
+
+    retry_number = 0
+
+    while True:
+        try:
+            return await hedge_image_request(session, params)
+        except Exception as ex:
+            if retry_number >= download_retry_count or not is_retryable_download_error(ex):
+                raise
+
+            wait_seconds = random.uniform(0.0, download_retry_base_seconds * 2 ** retry_number)
+
+            # wait at least as long as the WMS asks, if it says
+            if isinstance(ex, aiohttp.ClientResponseError) and ex.headers is not None:
+                try:
+                    wait_seconds = max(wait_seconds, float(ex.headers.get("Retry-After", 0.0)))
+                except ValueError:
+                    pass
+
+            retry_number += 1
+            download_stats["retries"] += 1
+
+            await asyncio.sleep(wait_seconds)
+
+
+async def hedge_image_request(session, params):
+    """Requests an image; and if hedging is on, requests it again if the first request is slow (and there's room under
+       the download limit). Returns whichever succeeds first (cancelling the other)"""
+
+    if download_hedge_seconds is None:
+        return await request_image(session, params)
+
+    first_request = asyncio.create_task(request_image(session, params))
+    done, _ = await asyncio.wait([first_request], timeout=download_hedge_seconds)
+    if first_request in done:
+        return first_request.result()
+
+    # don't add to the load when the WMS is already at the download limit
+    if download_limiter["active"] >= math.floor(download_limiter["limit"]):
+        return await first_request
+
+    download_stats["hedged_requests"] += 1
+    requests = {first_request, asyncio.create_task(request_image(session, params))}
+
+    error = None
+    while len(requests) > 0:
+        done, requests = await asyncio.wait(requests, return_when=asyncio.FIRST_COMPLETED)
+
+        for request in done:
+            if request.exception() is None:
+                for slow_request in requests:
+                    slow_request.cancel()
+                return request.result()
+
+            error = request.exception()
+
+    raise error
+
+
+async def request_image(session, params):
+    """Makes one WMS request (when the download limiter allows) and returns the image's raw bytes.
+       The response time & status are fed back into the download limiter"""
+
+    await acquire_download_limit()
+
+    outcome = None
+    start_time = time.perf_counter()
+
+    try:
+        async with session.get(wms_base_url, params=params) as response:
+            if response.status == 429 or response.status >= 500:
+                outcome = "overloaded"
+
+            # WMS errors can be returned as XML with an HTTP 200 status - don't treat these as images
+            response.raise_for_status()
+            if not response.content_type.startswith("image/"):
+                raise Exception(f"WMS returned {response.content_type} instead of an image")
+
+            image_bytes = await response.read()
+
+        if time.perf_counter() - start_time > slow_download_seconds:
+            outcome = "overloaded"
+        else:
+            outcome = "ok"
+
+        return image_bytes
+
+    except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError):
+        outcome = "overloaded"
+        raise
+
+    finally:
+        await release_download_limit(outcome)
+
+
+async def acquire_download_limit():
+    """Waits until there are fewer requests in flight than the current download limit"""
+
+    async with download_limiter["condition"]:
+        await download_limiter["condition"].wait_for(
+            lambda: download_limiter["active"] < math.floor(download_limiter["limit"]))
+        download_limiter["active"] += 1
+
+
+async def release_download_limit(outcome):
+    """Adjusts the download limit based on how a request went (additive increase, multiplicative decrease).
+       The limit is only halved once per slow download period; so a burst of failures doesn't crash it to the minimum"""
+
+    async with download_limiter["condition"]:
+        download_limiter["active"] -= 1
+
+        if outcome == "ok":
+            download_limiter["limit"] = min(download_limiter["limit"] + 1.0 / download_limiter["limit"],
+                                            download_limiter["max_limit"])
+        elif outcome == "overloaded":
+            now = time.perf_counter()
+            if now - download_limiter["last_decrease"] > slow_download_seconds:
+                download_limiter["limit"] = max(download_limiter["limit"] / 2.0, 1.0)
+                download_limiter["last_decrease"] = now
+
+        download_limiter["condition"].notify_all()
+
+
+def is_retryable_download_error(ex):
+    """Might the download work if it's retried? (i.e. the WMS is overloaded or the connection failed)"""
+
+    if isinstance(ex, aiohttp.ClientResponseError):
+        return ex.status == 429 or ex.status >= 500
+
+    return isinstance(ex, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+
+def get_tile_cache_path(params):
+    """Gets the tile cache file path for a WMS request. Images are keyed on a hash of the layer, CRS, bounds, size &
+       format requested; so any change in the request is a cache miss"""
+
+    cache_key = "|".join([str(params[key]) for key in ["layers", "crs", "bbox", "width", "height", "format"]])
+    cache_hash = hashlib.sha256(cache_key.encode("utf-8")).hexdigest()
+
+    # spread images across sub-directories to keep directory sizes manageable
+    return os.path.join(tile_cache_dir, cache_hash[:2], f"{cache_hash}.{params['format'].split('/')[-1]}")
+
+
+def read_tile_cache(params):
+    """Returns a cached image's raw bytes (None if it's not in the cache)"""
+
+    cache_path = get_tile_cache_path(params)
+
+    try:
+        with open(cache_path, "rb") as cache_file:
+            image_bytes = cache_file.read()
+    except FileNotFoundError:
+        return None
+
+    # touch the file to mark it as recently used (the cache is trimmed oldest first)
+    os.utime(cache_path)
+
+    return image_bytes
+
+
+def write_tile_cache(params, image_bytes):
+    """Saves a downloaded image's raw bytes to the tile cache. Trims the cache each time this process has written
+       tile_cache_trim_gb to it, so it can't outgrow its size limit by much during a run"""
+
+    global tile_cache_written_bytes
+
+    cache_path = get_tile_cache_path(params)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    # write to a temp file and rename it to avoid partial images if the script is stopped mid-write
+    temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as cache_file:
+        cache_file.write(image_bytes)
+    os.replace(temp_path, cache_path)
+
+    with tile_cache_lock:
+        tile_cache_written_bytes += len(image_bytes)
+        trim_cache = tile_cache_written_bytes >= tile_cache_trim_gb * 1024 ** 3
+        if trim_cache:
+            tile_cache_written_bytes = 0
+
+    if trim_cache:
+        trim_tile_cache()
+
+
+def trim_tile_cache():
+    """Deletes the least recently used images from the tile cache until it's under its size limit"""
+
+    max_bytes = tile_cache_max_gb * 1024 ** 3
+
+    cache_files = list()
+    cache_bytes = 0
+    for dir_path, _, file_names in os.walk(tile_cache_dir):
+        for file_name in file_names:
+            # skip images being written
+            if file_name.endswith(".tmp"):
+                continue
+
+            # other processes can trim the cache at the same time
+            try:
+                file_stat = os.stat(os.path.join(dir_path, file_name))
+            except FileNotFoundError:
+                continue
+
+            cache_files.append([file_stat.st_mtime, file_stat.st_size, os.path.join(dir_path, file_name)])
+            cache_bytes += file_stat.st_size
+
+    if cache_bytes <= max_bytes:
+        return
+
+    # delete oldest first
+    delete_count = 0
+    for _, file_size, file_path in sorted(cache_files):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+        cache_bytes -= file_size
+        delete_count += 1
+
+        if cache_bytes <= max_bytes:
+            break
+
+    logger.info(f"\t - {delete_count} images removed from the tile cache")
+
+
+def get_image_file_path(latitude, longitude):
+    """Creates the ID used to link an image with its labels & its state in the run ledger"""
+
+    # TODO: come up with a more meaningful ID for linking images with labels
+    return f"image_{latitude}_{longitude}.jpg"
+
+
+def make_ewkb_points(x_centres, y_centres):
+    """Creates hex encoded extended well known binary (EWKB) point geometries (SRID 4283) for a set of coords.
+    Postgres loads these without having to parse text"""
+
+    ewkb_points = numpy.empty(len(x_centres), dtype=ewkb_point_dtype)
+    ewkb_points["byte_order"] = 1  # little endian
+    ewkb_points["geometry_type"] = 0x20000001  # point with an SRID
+    ewkb_points["srid"] = 4283
+    ewkb_points["x"] = x_centres
+    ewkb_points["y"] = y_centres
+
+    return encode_ewkb(ewkb_points)
+
+
+def make_ewkb_polygons(x_mins, y_mins, x_maxs, y_maxs):
+    """Creates hex encoded extended well known binary (EWKB) polygon geometries (SRID 4283) for a set of bounding
+    boxes. Postgres loads these without having to parse text"""
+
+    ewkb_polygons = numpy.empty(len(x_mins), dtype=ewkb_polygon_dtype)
+    ewkb_polygons["byte_order"] = 1  # little endian
+    ewkb_polygons["geometry_type"] = 0x20000003  # polygon with an SRID
+    ewkb_polygons["srid"] = 4283
+    ewkb_polygons["ring_count"] = 1
+    ewkb_polygons["point_count"] = 5
+    ewkb_polygons["coords"] = numpy.stack([x_mins, y_mins, x_mins, y_maxs, x_maxs, y_maxs, x_maxs, y_mins,
+                                           x_mins, y_mins], axis=1)
+
+    return encode_ewkb(ewkb_polygons)
+
+
+def encode_ewkb(ewkb_array):
+    """Hex encodes an array of fixed size EWKB geometries in one go; returning a list of hex strings"""
+
+    hex_bytes = ewkb_array.tobytes().hex().encode("ascii")
+
+    return numpy.frombuffer(hex_bytes, dtype=f"S{ewkb_array.dtype.itemsize * 2}").astype(str).tolist()
+
+
+def get_label_bounds(tensor_labels, coords_list):
+    """Takes a batch of detected labels & converts them all at once to lat/long bounding boxes.
+    Returns a dict of arrays - file paths, image lat/longs, confidences & label bounds (x/y mins & maxs)
+
+    format of each image's labels is a tensor of:
+      0 - left pixel
+      1 - top pixel
+      2 - right pixel
+      3 - bottom pixel
+      4 - confidence (0.00 to 1.00)
+      5 - unknown (class? always 0.0)
+
+    e.g. [364.4530029296875, 480.5206298828125, 393.81219482421875, 512.9512939453125, 0.9367147088050842, 0.0]"""
+
+    label_counts = [len(tensor_label) for tensor_label in tensor_labels]
+
+    if sum(label_counts) > 0:
+        labels = torch.cat([tensor_label.cpu() for tensor_label in tensor_labels]).double().numpy()
+    else:
+        labels = numpy.empty((0, 6), dtype=numpy.float64)
+
+    # the top/left lat/long of each label's image
+    origins = numpy.repeat(numpy.array(coords_list, dtype=numpy.float64).reshape(-1, 2), label_counts, axis=0)
+
+    label_bounds = dict()
+    label_bounds["file_paths"] = list()
+    for coords, label_count in zip(coords_list, label_counts):
+        label_bounds["file_paths"].extend([get_image_file_path(coords[0], coords[1])] * label_count)
+
+    label_bounds["latitudes"] = origins[:, 0]
+    label_bounds["longitudes"] = origins[:, 1]
+    label_bounds["confidences"] = labels[:, 4]
+
+    # get lat/long boundaries by converting pixel coords to percentages, then to real world coords
+    label_bounds["x_mins"] = origins[:, 1] + width * labels[:, 0] / float(image_width)
+    label_bounds["y_mins"] = origins[:, 0] - height * labels[:, 3] / float(image_height)
+    label_bounds["x_maxs"] = origins[:, 1] + width * labels[:, 2] / float(image_width)
+    label_bounds["y_maxs"] = origins[:, 0] - height * labels[:, 1] / float(image_height)
+
+    return label_bounds
+
+
+def make_label_rows(label_bounds):
+    """Converts label bounds to label rows with centroid & boundary geometries for insertion into the database.
+    Returns a list of [file_path, confidence, latitude, longitude, point_geom, geom]"""
+
+    if len(label_bounds["file_paths"]) == 0:
+        return list()
+
+    # get centroid lat/longs
+    x_centres = (label_bounds["x_mins"] + label_bounds["x_maxs"]) / 2.0
+    y_centres = (label_bounds["y_mins"] + label_bounds["y_maxs"]) / 2.0
+
+    # create well known binary (EWKB) geometries
+    points = make_ewkb_points(x_centres, y_centres)
+    polygons = make_ewkb_polygons(label_bounds["x_mins"], label_bounds["y_mins"],
+                                  label_bounds["x_maxs"], label_bounds["y_maxs"])
+
+    return [list(row) for row in zip(label_bounds["file_paths"], label_bounds["confidences"].tolist(),
+                                     y_centres.tolist(), x_centres.tolist(), points, polygons)]
+
+
+def start_label_merge():
+    """Creates the store of labels held back to be merged with labels in overlapping images. Labels are found by
+       a grid hash (a dict of grid cells the size of the image stride & the labels touching them)"""
+
+    global label_merge
+
+    label_merge = dict()
+    label_merge["labels"] = collections.OrderedDict()  # held back labels by ID (oldest first)
+    label_merge["cells"] = dict()  # IDs of held back labels touching each grid cell
+    label_merge["waiting"] = dict()  # IDs of held back labels waiting on each image (by grid position)
+    label_merge["done_images"] = collections.OrderedDict()  # grid positions of recently done images
+    label_merge["finished"] = list()  # labels that are ready to save
+    label_merge["held_counts"] = dict()  # number of held back labels with labels from each image (by file path)
+    label_merge["unsaved_images"] = dict()  # coords of done images that still have held back labels (by file path)
+    label_merge["saved_images"] = list()  # coords of done images whose labels are all ready to save
+    label_merge["next_id"] = 0
+
+
+def merge_labels(label_bounds, coords_list, failed_coords_list=()):
+    """Merges a batch of labels with held back labels from overlapping images, then marks the batch's images (and
+       failed images) as done. Returns the bounds of labels that are ready to save (all the images they overlap are
+       done)"""
+
+    label_ids = list()
+
+    for i, file_path in enumerate(label_bounds["file_paths"]):
+        label = dict()
+        label["file_path"] = file_path
+        label["image_paths"] = {file_path}  # the images the label (& the labels merged into it) came from
+        label["confidence"] = label_bounds["confidences"][i]
+        label["bounds"] = [label_bounds["x_mins"][i], label_bounds["y_mins"][i],
+                           label_bounds["x_maxs"][i], label_bounds["y_maxs"][i]]
+        label["waiting"] = get_overlapping_images(
+            label["bounds"], get_grid_position([label_bounds["latitudes"][i], label_bounds["longitudes"][i]]))
+
+        label_ids.append(add_label_to_merge(label))
+
+    # the batch's images aren't inferred (in the run ledger) until all their labels are saved
+    for coords in coords_list:
+        label_merge["unsaved_images"][get_image_file_path(coords[0], coords[1])] = coords
+
+    for coords in itertools.chain(coords_list, failed_coords_list):
+        mark_image_done(get_grid_position(coords))
+
+    # finish the batch's labels that don't overlap any images that aren't done (no more labels can be merged with them)
+    for label_id in label_ids:
+        if label_id in label_merge["labels"] and len(label_merge["labels"][label_id]["waiting"]) == 0:
+            finish_label(label_id)
+
+    for coords in coords_list:
+        check_image_saved(get_image_file_path(coords[0], coords[1]))
+
+    # keep memory use in check by saving the oldest labels if too many are held back
+    while len(label_merge["labels"]) > max_held_label_count:
+        finish_label(next(iter(label_merge["labels"])))
+
+    return get_finished_label_bounds()
+
+
+def finish_label_merge():
+    """Returns the bounds of all labels still held back (once all images are done)"""
+
+    for label_id in list(label_merge["labels"]):
+        finish_label(label_id)
+
+    return get_finished_label_bounds()
+
+
+def add_label_to_merge(label):
+    """Merges a label with any held back labels that are the same pool (keeping the bounds of all of them & the highest
+       confidence), then holds it back until the images it overlaps are done. Returns the label's ID"""
+
+    for label_id in get_same_pool_label_ids(label):
+        same_label = remove_label_from_merge(label_id)
+
+        if same_label["confidence"] > label["confidence"]:
+            label["file_path"] = same_label["file_path"]
+            label["confidence"] = same_label["confidence"]
+
+        label["bounds"] = [min(label["bounds"][0], same_label["bounds"][0]),
+                           min(label["bounds"][1], same_label["bounds"][1]),
+                           max(label["bounds"][2], same_label["bounds"][2]),
+                           max(label["bounds"][3], same_label["bounds"][3])]
+        label["waiting"] |= same_label["waiting"]
+        label["image_paths"] |= same_label["image_paths"]
+
+    label_id = label_merge["next_id"]
+    label_merge["next_id"] += 1
+
+    label["cells"] = get_label_cells(label["bounds"])
+    label_merge["labels"][label_id] = label
+
+    for cell in label["cells"]:
+        label_merge["cells"].setdefault(cell, set()).add(label_id)
+
+    for image_position in label["waiting"]:
+        label_merge["waiting"].setdefault(image_position, set()).add(label_id)
+
+    for image_path in label["image_paths"]:
+        label_merge["held_counts"][image_path] = label_merge["held_counts"].get(image_path, 0) + 1
+
+    return label_id
+
+
+def remove_label_from_merge(label_id):
+    """Removes a held back label from the grid hash & the images it's waiting on"""
+
+    label = label_merge["labels"].pop(label_id)
+
+    for cell in label["cells"]:
+        label_merge["cells"][cell].discard(label_id)
+        if len(label_merge["cells"][cell]) == 0:
+            del label_merge["cells"][cell]
+
+    for image_position in label["waiting"]:
+        label_merge["waiting"][image_position].discard(label_id)
+        if len(label_merge["waiting"][image_position]) == 0:
+            del label_merge["waiting"][image_position]
+
+    for image_path in label["image_paths"]:
+        label_merge["held_counts"][image_path] -= 1
+        if label_merge["held_counts"][image_path] == 0:
+            del label_merge["held_counts"][image_path]
+
+    return label
+
+
+def finish_label(label_id):
+    """Stops holding back a label - it's ready to save"""
+
+    label = remove_label_from_merge(label_id)
+    label_merge["finished"].append(label)
+
+    for image_path in label["image_paths"]:
+        check_image_saved(image_path)
+
+
+def check_image_saved(image_path):
+    """Moves a done image to the saved images if none of its labels are held back any more"""
+
+    if image_path in label_merge["unsaved_images"] and image_path not in label_merge["held_counts"]:
+        label_merge["saved_images"].append(label_merge["unsaved_images"].pop(image_path))
+
+
+def mark_image_done(image_position):
+    """Records an image as done & finishes any held back labels that were only waiting on it"""
+
+    label_merge["done_images"][image_position] = True
+    label_merge["done_images"].move_to_end(image_position)
+
+    if run_image_grid is not None and is_run_image(image_position):
+        run_image_grid[image_position] = False
+
+    if len(label_merge["done_images"]) > max_done_image_count:
+        label_merge["done_images"].popitem(last=False)
+
+    for label_id in list(label_merge["waiting"].get(image_position, set())):
+        label = label_merge["labels"][label_id]
+        label["waiting"].discard(image_position)
+        label_merge["waiting"][image_position].discard(label_id)
+
+        if len(label["waiting"]) == 0:
+            finish_label(label_id)
+
+    label_merge["waiting"].pop(image_position, None)
+
+
+def get_same_pool_label_ids(label):
+    """Gets the IDs of held back labels that cover enough of the label (or the label covers enough of them) to be the
+       same pool"""
+
+    x_min, y_min, x_max, y_max = label["bounds"]
+    area = (x_max - x_min) * (y_max - y_min)
+
+    label_ids = set()
+
+    for cell in get_label_cells(label["bounds"]):
+        for label_id in label_merge["cells"].get(cell, set()):
+            other_x_min, other_y_min, other_x_max, other_y_max = label_merge["labels"][label_id]["bounds"]
+
+            overlap_width = min(x_max, other_x_max) - max(x_min, other_x_min)
+            overlap_height = min(y_max, other_y_max) - max(y_min, other_y_min)
+            if overlap_width <= 0.0 or overlap_height <= 0.0:
+                continue
+
+            other_area = (other_x_max - other_x_min) * (other_y_max - other_y_min)
+            if overlap_width * overlap_height >= label_merge_threshold * min(area, other_area):
+                label_ids.add(label_id)
+
+    return label_ids
+
+
+def get_label_cells(bounds):
+    """Gets the grid hash cells a label's bounds touch"""
+
+    x_min, y_min, x_max, y_max = bounds
+
+    return [(row, column)
+            for row in range(math.floor(y_min / y_stride), math.floor(y_max / y_stride) + 1)
+            for column in range(math.floor(x_min / x_stride), math.floor(x_max / x_stride) + 1)]
+
+
+def get_overlapping_images(bounds, image_position):
+    """Gets the grid positions of the images next to a label's image that the label overlaps (and aren't done yet)"""
+
+    x_min, y_min, x_max, y_max = bounds
+    row, column = image_position
+
+    image_positions = set()
+
+    for other_row in range(row - 1, row + 2):
+        for other_column in range(column - 1, column + 2):
+            other_position = (other_row, other_column)
+            if (other_position == image_position or other_position in label_merge["done_images"]
+                    or not is_run_image(other_position)):
+                continue
+
+            image_left = grid_origin[1] + other_column * x_stride
+            image_top = grid_origin[0] - other_row * y_stride
+
+            if x_max > image_left and x_min < image_left + width and y_max > image_top - height and y_min < image_top:
+                image_positions.add(other_position)
+
+    return image_positions
+
+
+def set_run_image_grid(flag_images=True):
+    """Overlapping images: flags the grid positions of the images in the run ledger that aren't done yet. Labels don't
+       wait on other positions - i.e. outside the grid or the clip boundary, or images done in an earlier run.
+       Distributed workers only flag the images in the batches they claim (see claim_job_groups())"""
+
+    global run_image_grid
+
+    # get postgres connection from pool
+    pg_conn = pg_pool.getconn()
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor()
+
+    pg_cur.execute(f"select min(latitude), max(longitude) from {tile_table}")
+    row = pg_cur.fetchone()
+
+    # clean up postgres connection
+    pg_cur.close()
+    pg_pool.putconn(pg_conn)
+
+    if row is None or row[0] is None:
+        run_image_grid = numpy.zeros((0, 0), dtype=bool)
+        return
+
+    # the bottom right image is the last row & column of the grid
+    row_count, column_count = get_grid_position([row[0], row[1]])
+    run_image_grid = numpy.zeros((row_count + 1, column_count + 1), dtype=bool)
+
+    if flag_images:
+        sql = f"select latitude, longitude from {tile_table} where state <> 'inferred'"
+
+        for job_chunk in split_list(stream_coords(sql), grid_fetch_size):
+            flag_run_images(job_chunk)
+
+
+def flag_run_images(coords_list):
+    """Overlapping images: flags the grid positions of a list of images as in the run & not done yet"""
+
+    coords = numpy.array(coords_list, dtype=numpy.float64)
+    rows = numpy.round((grid_origin[0] - coords[:, 0]) / y_stride).astype(int)
+    columns = numpy.round((coords[:, 1] - grid_origin[1]) / x_stride).astype(int)
+    run_image_grid[rows, columns] = True
+
+
+def is_run_image(image_position):
+    """Is the image at a grid position in the run & not done yet? (always True if the run's images aren't known)"""
+
+    if run_image_grid is None:
+        return True
+
+    row, column = image_position
+
+    return 0 <= row < run_image_grid.shape[0] and 0 <= column < run_image_grid.shape[1] and run_image_grid[row, column]
+
+
+def get_finished_label_bounds():
+    """Returns the labels that are ready to save as a dict of arrays (the same format as get_label_bounds())"""
+
+    finished_labels = label_merge["finished"]
+    label_merge["finished"] = list()
+
+    label_bounds = dict()
+    label_bounds["file_paths"] = [label["file_path"] for label in finished_labels]
+    label_bounds["confidences"] = numpy.array([label["confidence"] for label in finished_labels], dtype=numpy.float64)
+
+    bounds = numpy.array([label["bounds"] for label in finished_labels], dtype=numpy.float64).reshape(-1, 4)
+    label_bounds["x_mins"] = bounds[:, 0]
+    label_bounds["y_mins"] = bounds[:, 1]
+    label_bounds["x_maxs"] = bounds[:, 2]
+    label_bounds["y_maxs"] = bounds[:, 3]
+
+    return label_bounds
+
+
+def run_label_merge(merge_queue, merge_result):
+    """Merges the labels sent by the labelling processes & saves them (used when running on multiple devices)"""
+
+    start_label_merge()
+
+    label_count = 0
+
+    for label_bounds, coords_list, failed_coords_list in iter(merge_queue.get, None):
+        label_count += import_merged_label_rows(merge_labels(label_bounds, coords_list, failed_coords_list))
+
+    label_count += import_merged_label_rows(finish_label_merge())
+
+    flush_rows()
+
+    merge_result["label_count"] = label_count
+
+
+def tag_labels_with_parcel_and_address_ids():
+    """Tags all untagged labels with their land parcel and address IDs in one pass, using a set-based spatial join.
+    Labels with no match are left as NULL (possible due to the vagaries of addressing & land titling)"""
+
+    # get postgres connection from pool
+    pg_conn = pg_pool.getconn()
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    # get legal parcel ID and address ID using spatial join (joining on legal parcel ID is flaky due to GNAF's approach)
+    # TODO: import more than the first result.
+    #   Can return multiple addresses due to strata titles & the realities of 3D land titling
+    sql = f"""with tags as (
+                  select lab.ctid as label_ctid,
+                         ref.jurisdiction_id,
+                         ref.gnaf_pid,
+                         ref.address
+                  from {label_table} as lab
+                  cross join lateral (
+                      select cad.jurisdiction_id,
+                             gnaf.gnaf_pid,
+                             concat(gnaf.address, ', ', gnaf.locality_name, ' ', gnaf.state, ' ', gnaf.postcode) as address
+                      from {cad_table} as cad
+                      inner join {gnaf_table} as gnaf on st_intersects(gnaf.geom, cad.geom)
+                      where st_intersects(lab.point_geom, cad.geom)
+                      limit 1
+                  ) as ref
+                  where lab.legal_parcel_id is null
+              )
+              update {label_table} as lab
+                  set legal_parcel_id = tags.jurisdiction_id,
+                      gnaf_pid = tags.gnaf_pid,
+                      address = tags.address
+              from tags
+              where lab.ctid = tags.label_ctid"""
+    pg_cur.execute(sql)
+    tagged_label_count = pg_cur.rowcount
+
+    # clean up postgres connection
+    pg_cur.close()
+    pg_pool.putconn(pg_conn)
+
+    return tagged_label_count
+
+
+def insert_row(table_name, row):
+    """Buffers a python dictionary as a new row for a database table. Rows are copied into Postgres in bulk once the
+    flush size is reached or the flush time has passed (or when flush_rows() is called).
+    Allows for any number of columns and types; but column names and types MUST match existing columns"""
+
+    insert_rows(table_name, list(row.keys()), [list(row.values())])
+
+
+def insert_rows(table_name, columns, rows):
+    """Buffers a list of rows (lists of values in the same order as the column names) for a database table"""
+
+    with row_buffer_lock:
+        # the first rows buffered for a table set the column order
+        if table_name not in row_buffers:
+            row_buffers[table_name] = {"columns": columns, "rows": list()}
+
+        row_buffer = row_buffers[table_name]
+        if columns == row_buffer["columns"]:
+            row_buffer["rows"].extend(rows)
+        else:
+            for row in rows:
+                row_dict = dict(zip(columns, row))
+                row_buffer["rows"].append([row_dict.get(column) for column in row_buffer["columns"]])
+
+        buffered_row_count = sum([len(row_buffer["rows"]) for row_buffer in row_buffers.values()]) + len(tile_states)
+
+    if buffered_row_count >= postgres_flush_size or time.monotonic() - last_flush_time >= postgres_flush_seconds:
+        if row_writer is not None:
+            # let the background thread copy the rows (rows are buffered by the download event loop)
+            flush_requested.set()
+        else:
+            flush_rows()
+
+
+def start_row_writer():
+    """Starts a background thread that copies buffered rows into Postgres whenever the flush size or flush time is
+       reached. Until it's stopped, buffering rows never waits on Postgres"""
+
+    global row_writer
+
+    row_writer = dict()
+    row_writer["stop"] = threading.Event()
+    row_writer["thread"] = threading.Thread(target=run_row_writer, args=(row_writer["stop"],), daemon=True)
+    row_writer["thread"].start()
+
+
+def run_row_writer(stop_event):
+    """Copies buffered rows into Postgres when asked to (or every flush time), until stopped"""
+
+    while not stop_event.is_set():
+        flush_requested.wait(postgres_flush_seconds)
+        flush_requested.clear()
+
+        try:
+            flush_rows()
+        except Exception as ex:
+            # the images' ledger states weren't updated either - they'll be processed again if the run is resumed
+            logger.error(f"\t - couldn't copy rows into Postgres : {ex}")
+
+
+def stop_row_writer():
+    """Stops the background row writer once it has finished any flush it's doing (rows left are flushed by the caller)"""
+
+    global row_writer
+
+    if row_writer is None:
+        return
+
+    row_writer["stop"].set()
+    flush_requested.set()
+    row_writer["thread"].join()
+
+    row_writer = None
+
+
+def set_tile_state(latitude, longitude, state):
+    """Buffers an image's processing state for the run ledger (pending, downloaded, inferred or failed).
+    States are updated in Postgres with the next flush of buffered rows"""
+
+    with row_buffer_lock:
+        tile_states[get_image_file_path(latitude, longitude)] = state
+
+
+def flush_rows():
+    """Copies all buffered rows into their database tables using COPY, and updates buffered image states in the run
+    ledger; all in a single transaction"""
+
+    global row_buffers
+    global tile_states
+    global last_flush_time
+
+    with flush_lock:
+        last_flush_time = time.monotonic()
+
+        # swap out the buffers so new rows can be buffered while these ones are copied
+        with row_buffer_lock:
+            table_buffers = row_buffers
+            state_buffer = tile_states
+            row_buffers = dict()
+            tile_states = dict()
+
+        if len(table_buffers) == 0 and len(state_buffer) == 0:
+            return
+
+        write_start_time = time.perf_counter()
+
+        # get postgres connection from pool
+        pg_conn = pg_pool.getconn()
+        pg_conn.autocommit = False
+        pg_cur = pg_conn.cursor()
+
+        try:
+            if fence_batch_writes:
+                table_buffers, state_buffer = fence_rows(pg_cur, table_buffers, state_buffer)
+
+            for table_name, row_buffer in table_buffers.items():
+                copy_file = io.StringIO()
+                for values in row_buffer["rows"]:
+                    copy_file.write("\t".join([format_copy_value(value) for value in values]) + "\n")
+                copy_file.seek(0)
+
+                pg_cur.copy_expert(f"COPY {table_name} ({','.join(row_buffer['columns'])}) FROM STDIN", copy_file)
+
+            if len(state_buffer) > 0:
+                # inferred images are never changed (with multiple devices & overlapping images, images are recorded as
+                # inferred by the main process - possibly before a labelling process flushes their downloaded state)
+                sql = f"""update {tile_table} as tile
+                              set state = upd.state,
+                                  updated = now()
+                          from (values %s) as upd (file_path, state)
+                          where tile.file_path = upd.file_path
+                            and tile.state <> 'inferred'"""
+                psycopg2.extras.execute_values(pg_cur, sql, list(state_buffer.items()), page_size=postgres_flush_size)
+
+            pg_conn.commit()
+
+            record_timing("postgres_write_seconds", time.perf_counter() - write_start_time)
+            count_metric("postgres_rows", sum([len(row_buffer["rows"]) for row_buffer in table_buffers.values()]))
+            count_metric("postgres_state_updates", len(state_buffer))
+        except Exception:
+            pg_conn.rollback()
+            raise
+        finally:
+            # clean up postgres connection
+            pg_cur.close()
+            pg_conn.autocommit = True
+            pg_pool.putconn(pg_conn)
+
+
+def fence_rows(pg_cur, table_buffers, state_buffer):
+    """Distributed runs: removes buffered rows & image states for images in batches this worker no longer has a claim
+       on (its claim expired & another worker has claimed the batch - that worker writes the batch's results instead).
+       The worker's batches are locked until the flush is committed, so they can't be claimed in the meantime"""
+
+    file_paths = set(state_buffer)
+    for row_buffer in table_buffers.values():
+        file_path_index = row_buffer["columns"].index("file_path")
+        file_paths.update([row[file_path_index] for row in row_buffer["rows"]])
+
+    # note: key share locks block claims (select for update) but not claim renewals (updates of non-key columns)
+    pg_cur.execute(f"""select tile.file_path
+                       from {tile_table} as tile
+                       inner join {batch_table} as batch on batch.batch_id = tile.batch_id
+                       where tile.file_path = any(%s)
+                         and batch.worker = %s
+                       for key share of batch""", (list(file_paths), worker_name))
+    claimed_file_paths = set([row[0] for row in pg_cur.fetchall()])
+
+    if len(claimed_file_paths) == len(file_paths):
+        return table_buffers, state_buffer
+
+    logger.warning(f"\t - {len(file_paths) - len(claimed_file_paths)} images' results not saved : their batches have "
+                   f"been claimed by another worker")
+
+    fenced_table_buffers = dict()
+    for table_name, row_buffer in table_buffers.items():
+        file_path_index = row_buffer["columns"].index("file_path")
+        fenced_table_buffers[table_name] = {"columns": row_buffer["columns"],
+                                            "rows": [row for row in row_buffer["rows"]
+                                                     if row[file_path_index] in claimed_file_paths]}
+
+    fenced_state_buffer = {file_path: state for file_path, state in state_buffer.items()
+                           if file_path in claimed_file_paths}
+
+    return fenced_table_buffers, fenced_state_buffer
+
+
+def format_copy_value(value):
+    """Formats a python value as a field in Postgres' COPY text format"""
+
+    if value is None:
+        return "\\N"
+
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def import_labels_to_postgres(tensor_labels, coords_list, failed_coords_list=()):
+    """Inserts a batch of images' labels into the database & returns the number of labels.
+       If images overlap, labels are merged first (only labels that are ready are inserted) or sent to the main process
+       to be merged (the number of labels before merging is returned). Labels held back for merging stop waiting on
+       the batch's failed images"""
+
+    label_bounds = get_label_bounds(tensor_labels, coords_list)
+
+    # DEBUG: log label counts
+    # logger.info(f"{len(label_bounds['file_paths'])} pools in {len(coords_list)} images")
+
+    if label_merge_queue is not None:
+        label_merge_queue.put([label_bounds, coords_list, failed_coords_list])
+        return len(label_bounds["file_paths"])
+
+    if label_merge is not None:
+        return import_merged_label_rows(merge_labels(label_bounds, coords_list, failed_coords_list))
+
+    return import_label_rows(make_label_rows(label_bounds))
+
+
+def import_label_rows(label_rows):
+    """Buffers label rows for bulk insert into the database & returns the number of labels"""
+
+    # note: legal parcel identifier & address ID (gnaf_pid) are tagged after detection if using reference data
+    insert_rows(label_table, ["file_path", "confidence", "latitude", "longitude", "point_geom", "geom"], label_rows)
+
+    return len(label_rows)
+
+
+def import_merged_label_rows(label_bounds):
+    """Buffers merged labels that are ready to save & returns the number of labels. Then records the images whose
+       labels have all been saved as inferred in the run ledger (buffered after their labels, so a flush can't commit
+       an image as inferred without its labels)"""
+
+    label_count = import_label_rows(make_label_rows(label_bounds))
+
+    for coords in label_merge["saved_images"]:
+        set_tile_state(coords[0], coords[1], "inferred")
+    label_merge["saved_images"] = list()
+
+    return label_count
+
+
+def import_image_to_postgres(latitude, longitude):
+    """Inserts an image's polygon & metadata into the database"""
+
+    image_path = get_image_file_path(latitude, longitude)
+
+    # import image bounds as polygons for reference
+    x_max = longitude + width
+    y_min = latitude - height
+
+    image_row = dict()
+    image_row["file_path"] = image_path
+    # image_row["label_count"] = label_count
+    image_row["width"] = width
+    image_row["height"] = width
+    image_row["geom"] = make_ewkb_polygons([longitude], [y_min], [x_max], [latitude])[0]
+    insert_row(image_table, image_row)
+
+
+def record_timing(name, seconds):
+    """Adds a stage's run time (seconds) to its histogram in the run metrics"""
+
+    record_histogram_value(name, seconds, timing_buckets)
+
+
+def record_histogram_value(name, value, buckets):
+    """Adds a value to a histogram in the run metrics (safe to call from any thread). Histograms only keep counts per
+       bucket, so they're cheap to add to & can be merged across processes"""
+
+    with run_metric_lock:
+        histogram = run_metrics["histograms"].get(name)
+        if histogram is None:
+            histogram = {"buckets": buckets, "counts": [0] * len(buckets), "count": 0, "sum": 0.0, "max": 0.0}
+            run_metrics["histograms"][name] = histogram
+
+        histogram["counts"][bisect.bisect_left(buckets, value)] += 1
+        histogram["count"] += 1
+        histogram["sum"] += value
+        histogram["max"] = max(histogram["max"], value)
+
+
+def count_metric(name, count=1):
+    """Adds to a count in the run metrics (safe to call from any thread)"""
+
+    with run_metric_lock:
+        run_metrics["counts"][name] = run_metrics["counts"].get(name, 0) + count
+
+
+def record_memory_use(device_tag, device):
+    """Adds this process's peak memory use (RSS) & peak GPU memory use (if using one) to the run metrics"""
+
+    # peak RSS is in KB on Linux & bytes on MacOS
+    process_peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() != "Darwin":
+        process_peak_rss_bytes *= 1024
+
+    # include the peaks from before run_model() last reset the peak RSS
+    process_peak_rss_bytes = max(process_peak_rss_bytes, peak_rss_bytes)
+
+    memory_use = {"device": device_tag, "pid": os.getpid(), "peak_rss_bytes": process_peak_rss_bytes}
+    if device.type == "cuda":
+        memory_use["peak_cuda_allocated_bytes"] = torch.cuda.max_memory_allocated(device)
+        memory_use["peak_cuda_reserved_bytes"] = torch.cuda.max_memory_reserved(device)
+
+    with run_metric_lock:
+        run_metrics["memory"].append(memory_use)
+
+
+def merge_run_metrics(process_metrics):
+    """Adds another process's run metrics to this process's"""
+
+    with run_metric_lock:
+        for name, process_histogram in process_metrics["histograms"].items():
+            histogram = run_metrics["histograms"].get(name)
+            if histogram is None:
+                run_metrics["histograms"][name] = process_histogram
+                continue
+
+            histogram["counts"] = [count + process_count
+                                   for count, process_count in zip(histogram["counts"], process_histogram["counts"])]
+            histogram["count"] += process_histogram["count"]
+            histogram["sum"] += process_histogram["sum"]
+            histogram["max"] = max(histogram["max"], process_histogram["max"])
+
+        for name, count in process_metrics["counts"].items():
+            run_metrics["counts"][name] = run_metrics["counts"].get(name, 0) + count
+
+        run_metrics["memory"].extend(process_metrics["memory"])
+
+
+def get_histogram_percentile(histogram, percentile):
+    """Estimates a percentile from a histogram's buckets (by interpolating within the bucket it falls in)"""
+
+    if histogram["count"] == 0:
+        return 0.0
+
+    target_count = histogram["count"] * percentile / 100.0
+    cumulative_count = 0
+    lower_bound = 0.0
+
+    for upper_bound, count in zip(histogram["buckets"], histogram["counts"]):
+        if count > 0 and cumulative_count + count >= target_count:
+            # the last bucket has no upper bound - use the max value seen
+            upper_bound = min(upper_bound, histogram["max"])
+            return lower_bound + (upper_bound - lower_bound) * (target_count - cumulative_count) / count
+
+        cumulative_count += count
+        lower_bound = upper_bound
+
+    return histogram["max"]
+
+
+def save_run_report(summary):
+    """Logs a summary of each stage's timings & saves the run report (the summary plus all run metrics) as JSON;
+       and in Prometheus' text format if a file is set"""
+
+    report = dict(summary)
+    report["stages"] = dict()
+
+    for name, histogram in sorted(run_metrics["histograms"].items()):
+        stage = {"count": histogram["count"], "sum": histogram["sum"], "max": histogram["max"],
+                 "mean": histogram["sum"] / max(histogram["count"], 1)}
+        for percentile in [50, 90, 99]:
+            stage[f"p{percentile}"] = get_histogram_percentile(histogram, percentile)
+
+        # bucket counts keyed by upper bound (JSON has no infinity)
+        stage["buckets"] = {("+Inf" if math.isinf(bound) else str(bound)): count
+                            for bound, count in zip(histogram["buckets"], histogram["counts"])}
+
+        report["stages"][name] = stage
+
+        logger.info(f"\t - {name} : {stage['count']} : mean {stage['mean']:.4f} : p50 {stage['p50']:.4f} : "
+                    f"p99 {stage['p99']:.4f} : max {stage['max']:.4f}")
+
+    report["counts"] = dict(sorted(run_metrics["counts"].items()))
+    report["memory"] = run_metrics["memory"]
+
+    if run_report_path is not None:
+        with open(run_report_path, "w") as report_file:
+            json.dump(report, report_file, indent=2, default=str)
+
+        logger.info(f"Run report saved to {run_report_path}")
+
+    if prometheus_file_path is not None:
+        save_prometheus_file(report)
+
+
+def save_prometheus_file(report):
+    """Saves the run report in Prometheus' text exposition format. Written to a temp file first & then renamed, so a
+       collector never reads half a file"""
+
+    lines = list()
+
+    for name in ["image_count", "image_fail_count", "label_count", "labelling_seconds", "images_per_second"]:
+        lines.append(f"# TYPE pool_detection_{name} gauge")
+        lines.append(f"pool_detection_{name} {report[name]}")
+
+    for name, histogram in sorted(run_metrics["histograms"].items()):
+        metric_name = f"pool_detection_{name}"
+        lines.append(f"# TYPE {metric_name} histogram")
+
+        cumulative_count = 0
+        for bound, count in zip(histogram["buckets"], histogram["counts"]):
+            cumulative_count += count
+            lines.append(f'{metric_name}_bucket{{le="{"+Inf" if math.isinf(bound) else bound}"}} {cumulative_count}')
+
+        lines.append(f"{metric_name}_sum {histogram['sum']}")
+        lines.append(f"{metric_name}_count {histogram['count']}")
+
+    for name, count in sorted(run_metrics["counts"].items()):
+        lines.append(f"# TYPE pool_detection_{name}_total counter")
+        lines.append(f"pool_detection_{name}_total {count}")
+
+    for memory_name in ["peak_rss_bytes", "peak_cuda_allocated_bytes", "peak_cuda_reserved_bytes"]:
+        memory_lines = [f'pool_detection_{memory_name}{{device="{memory_use["device"]}",pid="{memory_use["pid"]}"}} '
+                        f'{memory_use[memory_name]}' for memory_use in run_metrics["memory"] if memory_name in memory_use]
+        if len(memory_lines) > 0:
+            lines.append(f"# TYPE pool_detection_{memory_name} gauge")
+            lines.extend(memory_lines)
+
+    temp_file_path = f"{prometheus_file_path}.{os.getpid()}.tmp"
+    with open(temp_file_path, "w") as prometheus_file:
+        prometheus_file.write("\n".join(lines) + "\n")
+
+    os.replace(temp_file_path, prometheus_file_path)
+
+
+def setup_logging():
+    """Logs to a file & the screen (also used by each labelling process in multi-device runs)"""
+
+    global logger
+
+    logger = logging.getLogger()
+
+    # set logger
+    log_file = os.path.abspath(__file__).replace(".py", ".log")
+    logging.basicConfig(filename=log_file, level=logging.DEBUG, format="%(asctime)s %(message)s",
+                        datefmt="%m/%d/%Y %I:%M:%S %p")
+
+    # setup logger to write to screen as well as writing to log file
+    # define a Handler which writes INFO messages or higher to the sys.stderr
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    # set a format which is simpler for console use
+    formatter = logging.Formatter("%(name)-12s: %(levelname)-8s %(message)s")
+    # tell the handler to use this format
+    console.setFormatter(formatter)
+    # add the handler to the root logger
+    logging.getLogger("").addHandler(console)
+
+
+if __name__ == "__main__":
+    # setup logging
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="Detects residential swimming pools in aerial images")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume the last run: keeps its results & only processes images that didn't finish")
+    parser.add_argument("--seed", action="store_true",
+                        help="Distributed run: queue the images in batches for workers to claim (no images are "
+                             "processed). Use with --resume to queue the images that didn't finish in the last run")
+    parser.add_argument("--worker", action="store_true",
+                        help="Distributed run: process batches of images from the queue until it's empty. "
+                             "Run as many workers as you like, on any number of hosts sharing the same database")
+
+    main(parser.parse_args())
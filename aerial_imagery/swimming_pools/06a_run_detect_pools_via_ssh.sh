@@ -9,13 +9,30 @@ SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 
 # copy and run python script remotely
 FILENAME="06_detect_pools.py"
-scp -F ${SSH_CONFIG} ${SCRIPT_DIR}/${FILENAME} ${USER}@${INSTANCE_ID}:~/
-ssh -F ${SSH_CONFIG} ${INSTANCE_ID} "conda activate yolov5; rm ~/06_detect_pools.log; python3 ${FILENAME}"
+
+if [ -z "${INSTANCE_IDS}" ]; then
+  scp -F ${SSH_CONFIG} ${SCRIPT_DIR}/${FILENAME} ${USER}@${INSTANCE_ID}:~/
+  ssh -F ${SSH_CONFIG} ${INSTANCE_ID} "conda activate yolov5; rm ~/06_detect_pools.log; python3 ${FILENAME}"
+else
+  # distributed run: queue the image batches from the first instance, then run a worker on every instance
+  # (pg_connect_string in 06_detect_pools.py must point to a Postgres database all instances can reach)
+  for ID in ${INSTANCE_IDS}; do
+    scp -F ${SSH_CONFIG} ${SCRIPT_DIR}/${FILENAME} ${USER}@${ID}:~/
+  done
+
+  ssh -F ${SSH_CONFIG} ${INSTANCE_ID} "conda activate yolov5; rm ~/06_detect_pools.log; python3 ${FILENAME} --seed"
+
+  for ID in ${INSTANCE_IDS}; do
+    ssh -F ${SSH_CONFIG} ${ID} "conda activate yolov5; python3 ${FILENAME} --worker" &
+  done
+  wait
+fi
 
 # dump results from Postgres and copy locally
 ssh -F ${SSH_CONFIG} ${INSTANCE_ID} "conda activate yolov5; pg_dump -Fc -d geo -t data_science.pool_images -t data_science.pool_labels -p 5432 -U ec2-user -f ~/pools.dmp --no-owner"
 scp -F ${SSH_CONFIG} ${USER}@${INSTANCE_ID}:~/pools.dmp ${SCRIPT_DIR}/
 scp -F ${SSH_CONFIG} ${USER}@${INSTANCE_ID}:~/06_detect_pools.log  ${SCRIPT_DIR}/
+scp -F ${SSH_CONFIG} ${USER}@${INSTANCE_ID}:~/06_detect_pools_report.json  ${SCRIPT_DIR}/
 
 # load into local postgres (WARNING: force drops tables first)
 /Applications/Postgres.app/Contents/Versions/13/bin/psql -d geo -c "drop table data_science.pool_images cascade"
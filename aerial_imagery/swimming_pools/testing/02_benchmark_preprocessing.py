@@ -0,0 +1,133 @@
+"""-----------------------------------------------------------------------------------------------------------------
+ Benchmarks the 2 ways 06_detect_pools.py can get images into the model:
+ - PIL: JPEG bytes -> Pillow image -> YOLOv5's AutoShape (converts, letterboxes & copies each image)
+ - fast: JPEG bytes -> decoded straight into a reused uint8 batch tensor -> model -> non-maximum suppression
+
+ Uses images from the tile cache if there are any (i.e. after running 06_detect_pools.py) or 640x640 tiles cut from
+ the sample images. Uses the model & device settings in 06_detect_pools.py
+
+ License: Apache v2
+-----------------------------------------------------------------------------------------------------------------"""
+
+import glob
+import importlib
+import io
+import logging
+import numpy
+import os
+import sys
+import time
+import torch
+
+from PIL import Image
+
+# the directory of this script & the pool detection script
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(script_dir))
+detector = importlib.import_module("06_detect_pools")
+
+# number of images per batch & number of timed runs per preprocessing method
+batch_size = 64
+run_count = 5
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    detector.logger = logging.getLogger()
+
+    image_list = get_sample_images()
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model = detector.load_model(device)
+
+    print(f"Benchmarking {run_count} runs of {len(image_list)} images on {device}")
+
+    # time decoding only
+    for name, decode_function in [["PIL", decode_pil], ["fast", decode_fast]]:
+        seconds = time_function(lambda: decode_function(image_list, device))
+        print(f"\t - {name} decode : {seconds / len(image_list) * 1000.0:.2f} ms per image")
+
+    # time decoding, preprocessing & inference end to end; and check both methods find the same labels
+    label_counts = dict()
+
+    for name, fast_preprocessing in [["PIL", False], ["fast", True]]:
+        detector.fast_preprocessing = fast_preprocessing
+
+        seconds = time_function(lambda: detector.detect_pools(model, device, image_list))
+        tensor_labels = detector.detect_pools(model, device, image_list)
+        label_counts[name] = [len(tensor_label) for tensor_label in tensor_labels]
+
+        print(f"\t - {name} end to end : {seconds / len(image_list) * 1000.0:.2f} ms per image : "
+              f"{len(image_list) / seconds:.1f} images/sec : {sum(label_counts[name])} labels")
+
+    # the fast method doesn't letterbox; so small differences in labels are expected, big ones are a bug
+    different_image_count = len([True for pil_count, fast_count in zip(label_counts["PIL"], label_counts["fast"])
+                                 if pil_count != fast_count])
+    print(f"\t - {different_image_count} images have a different label count between methods")
+
+
+def get_sample_images():
+    """Gets a batch of JPEG images as raw bytes; from the tile cache or cut from the sample images"""
+
+    image_list = list()
+
+    if detector.tile_cache_dir is not None:
+        for file_path in glob.glob(os.path.join(detector.tile_cache_dir, "*", "*.jpeg"))[:batch_size]:
+            with open(file_path, "rb") as image_file:
+                image_list.append(image_file.read())
+
+    if len(image_list) < batch_size:
+        image_list = list()
+        sample_images = [Image.open(file_path).convert("RGB")
+                         for file_path in glob.glob(os.path.join(os.path.dirname(script_dir), "sample-images", "*.png"))]
+
+        while len(image_list) < batch_size:
+            sample_image = sample_images[len(image_list) % len(sample_images)]
+
+            # step the tiles across & down the sample image
+            step = len(image_list) * 97
+            left = step % (sample_image.width - detector.image_width)
+            top = step % (sample_image.height - detector.image_height)
+
+            tile = sample_image.crop((left, top, left + detector.image_width, top + detector.image_height))
+            image_file = io.BytesIO()
+            tile.save(image_file, format="JPEG")
+            image_list.append(image_file.getvalue())
+
+    return image_list
+
+
+def decode_pil(image_list, device):
+    """Decodes images the way YOLOv5's AutoShape does - one Pillow image at a time, then into a batch tensor"""
+
+    image_arrays = [torch.from_numpy(numpy.array(Image.open(io.BytesIO(image_bytes)).convert("RGB")))
+                    for image_bytes in image_list]
+
+    return torch.stack(image_arrays).permute(0, 3, 1, 2).contiguous().to(device)
+
+
+def decode_fast(image_list, device):
+    return detector.get_image_batch_tensor(image_list, device)
+
+
+def time_function(function):
+    """Returns the average run time of a function in seconds (after a warm up run)"""
+
+    function()
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    start_time = time.perf_counter()
+
+    for _ in range(run_count):
+        function()
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - start_time) / run_count
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""-----------------------------------------------------------------------------------------------------------------
+ Validates the pre-inference pool filter in 06_detect_pools.py against the labelled training images: measures the
+ recall cost (training images with pools the filter would skip) vs. the throughput gain (images without pools that
+ are skipped) for a range of filter thresholds.
+
+ Uses the training images & label counts loaded into Postgres by 04_load_training_data_to_postgres.py. Images are
+ JPEG encoded first, to match the images that come from the WMS. Uses the pool colour & model settings in
+ 06_detect_pools.py
+
+ License: Apache v2
+-----------------------------------------------------------------------------------------------------------------"""
+
+import importlib
+import io
+import logging
+import numpy
+import os
+import psycopg2
+import rasterio
+import sys
+import time
+import torch
+
+from PIL import Image
+
+# the directory of this script, the pool detection script & the training data loading script
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(script_dir))
+detector = importlib.import_module("06_detect_pools")
+loader = importlib.import_module("04_load_training_data_to_postgres")
+
+# filter thresholds to test (min fraction of pool coloured pixels)
+min_fractions = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01]
+
+# max number of training images to test (None = all)
+image_limit = 5000
+
+# share of images in a detection run that have pools (used to estimate the throughput gain - the training images
+# have a lot more pools than a typical grid of images)
+pool_image_share = 0.1
+
+# number of images used to time the model
+model_batch_size = 32
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    detector.logger = logging.getLogger()
+
+    image_list, pool_flags = get_training_images()
+    pool_flags = numpy.array(pool_flags)
+
+    print(f"Validating the pool filter on {len(image_list)} training images : {pool_flags.sum()} with pools")
+
+    # get the fraction of pool coloured pixels in each image
+    start_time = time.perf_counter()
+    pool_fractions = numpy.array([detector.get_pool_colour_fraction(image_data) for image_data in image_list])
+    filter_seconds = (time.perf_counter() - start_time) / len(image_list)
+
+    model_seconds = time_model(image_list)
+
+    print(f"\t - filter : {filter_seconds * 1000.0:.2f} ms per image : model : {model_seconds * 1000.0:.2f} ms per image")
+
+    for min_fraction in min_fractions:
+        kept_flags = pool_fractions >= min_fraction
+
+        # recall: images with pools the filter lets through; skip rate: images without pools it skips
+        recall = kept_flags[pool_flags].mean() if pool_flags.any() else 1.0
+        skip_rate = 1.0 - kept_flags[~pool_flags].mean() if (~pool_flags).any() else 0.0
+
+        # estimated images/sec on a grid of images, with & without the filter
+        skipped_share = (1.0 - pool_image_share) * skip_rate + pool_image_share * (1.0 - recall)
+        filtered_seconds = filter_seconds + (1.0 - skipped_share) * model_seconds
+
+        print(f"\t - min fraction {min_fraction} : recall {recall:.1%} : {skip_rate:.1%} of images without pools "
+              f"skipped : ~{model_seconds / filtered_seconds:.2f}x images/sec")
+
+
+def get_training_images():
+    """Gets the training images as JPEG bytes & whether they have pools (labels)"""
+
+    pg_conn = psycopg2.connect(loader.pg_connect_string)
+    pg_cur = pg_conn.cursor()
+
+    sql = f"""select img.file_path,
+                     count(lab.file_path) as label_count
+              from {loader.image_table} as img
+              left outer join {loader.label_table} as lab on lab.file_path = img.file_path
+              group by img.file_path
+              order by random()"""
+    if image_limit is not None:
+        sql += f" limit {image_limit}"
+
+    pg_cur.execute(sql)
+    rows = pg_cur.fetchall()
+
+    pg_cur.close()
+    pg_conn.close()
+
+    image_list = list()
+    pool_flags = list()
+
+    for file_path, label_count in rows:
+        if not os.path.isfile(file_path):
+            continue
+
+        with rasterio.open(file_path) as image:
+            image_array = image.read([1, 2, 3])
+
+        image_file = io.BytesIO()
+        Image.fromarray(numpy.moveaxis(image_array, 0, -1)).save(image_file, format="JPEG")
+
+        image_list.append(image_file.getvalue())
+        pool_flags.append(label_count > 0)
+
+    return image_list, pool_flags
+
+
+def time_model(image_list):
+    """Returns the model's run time per image in seconds (after a warm up run)"""
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model = detector.load_model(device)
+
+    # training images aren't necessarily the size of the images the model is run on - let YOLOv5 resize them
+    detector.fast_preprocessing = False
+
+    model_image_list = image_list[:model_batch_size]
+    detector.detect_pools(model, device, model_image_list)
+
+    start_time = time.perf_counter()
+    detector.detect_pools(model, device, model_image_list)
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - start_time) / len(model_image_list)
+
+
+if __name__ == "__main__":
+    main()
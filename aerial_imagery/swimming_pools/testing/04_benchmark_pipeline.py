@@ -0,0 +1,292 @@
+"""-----------------------------------------------------------------------------------------------------------------
+ Benchmarks 06_detect_pools.py's image pipeline end to end, offline - without the NSW DCS WMS or a trained model:
+ - a local stand-in for the WMS serves JPEGs cut from the sample images, with a random delay & error rate
+ - a stub model decodes each batch of images (as the real one does) & returns random labels instantly
+ - images are run through the real pipeline (get_jobs() -> get_labels()) over grids of increasing size, writing to a
+   local Postgres database (run 03_create_tables.sql in it first)
+
+ Reports images/sec, p50/p99 download & inference times & Postgres rows/sec for each grid; and how much they've
+ changed since the last benchmark (results are saved to 04_benchmark_pipeline_results.json)
+
+ License: Apache v2
+-----------------------------------------------------------------------------------------------------------------"""
+
+import aiohttp.web
+import asyncio
+import importlib
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import psycopg2
+import psycopg2.pool
+import random
+import sys
+import time
+import torch
+
+from PIL import Image
+
+# the directory of this script & the pool detection script
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(script_dir))
+detector = importlib.import_module("06_detect_pools")
+
+# number of images in each grid to benchmark
+grid_image_counts = [1000, 10000, 100000]
+
+# local Postgres database to write the results to (needs the tables in 03_create_tables.sql - they're truncated!)
+pg_connect_string = detector.pg_connect_string
+
+# fake WMS: address; the mean time it takes to respond (random, exponentially distributed - i.e. a long tail of slow
+# responses); and the fraction of requests that fail with a "503 Service Unavailable" (these are retried)
+wms_host = "127.0.0.1"
+wms_port = 8765
+wms_delay_seconds = 0.05
+wms_error_rate = 0.01
+
+# number of different images the fake WMS serves (cut from the sample images)
+wms_image_count = 16
+
+# stub model: fraction of images with a pool (label)
+stub_pool_image_share = 0.1
+
+# run the trained model instead of the stub (needs YOLOv5 & the model - see 06_detect_pools.py)
+use_real_model = False
+
+# images/sec drops bigger than this (vs. the last benchmark) are flagged as regressions
+regression_threshold = 0.1
+
+results_path = os.path.join(script_dir, "04_benchmark_pipeline_results.json")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    detector.logger = logging.getLogger()
+
+    # point the pipeline at the fake WMS (no tile cache - every image is downloaded)
+    detector.imagery_source = "wms"
+    detector.wms_base_url = f"http://{wms_host}:{wms_port}/wms"
+    detector.tile_cache_dir = None
+    detector.pg_connect_string = pg_connect_string
+
+    device_tag = "cuda:0" if torch.cuda.is_available() else "cpu"
+    if not use_real_model:
+        detector.load_model = load_stub_model
+        detector.detect_pools = detect_pools_with_stub_model
+
+    # start the fake WMS in its own process (so it doesn't compete with the pipeline for the GIL)
+    wms_ready = multiprocessing.Event()
+    wms_process = multiprocessing.Process(target=run_fake_wms, args=(wms_ready,), daemon=True)
+    wms_process.start()
+    if not wms_ready.wait(30):
+        raise Exception("fake WMS didn't start")
+
+    # connect to Postgres after the fake WMS process is forked, so it doesn't inherit the pool's connections
+    detector.pg_pool = psycopg2.pool.ThreadedConnectionPool(1, detector.max_postgres_connections, pg_connect_string)
+
+    print(f"Benchmarking on {device_tag} : {'model' if use_real_model else 'stub model'} : "
+          f"WMS delay {wms_delay_seconds}s : WMS error rate {wms_error_rate:.1%}")
+
+    results = list()
+
+    try:
+        for grid_image_count in grid_image_counts:
+            results.append(run_benchmark(device_tag, grid_image_count))
+    finally:
+        wms_process.terminate()
+        detector.pg_pool.closeall()
+
+    compare_with_last_results(results)
+
+    with open(results_path, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+
+
+def run_benchmark(device_tag, grid_image_count):
+    """Runs the pipeline over a grid of images & returns its throughput & stage timings"""
+
+    clear_tables()
+    set_grid_bounds(grid_image_count)
+
+    # start each grid with fresh run metrics
+    detector.run_metrics = {"histograms": dict(), "counts": dict(), "memory": list()}
+
+    start_time = time.perf_counter()
+
+    image_count, job_groups = detector.get_jobs(False)
+    label_count, image_fail_count = detector.get_labels(device_tag, job_groups)
+
+    seconds = time.perf_counter() - start_time
+
+    histograms = detector.run_metrics["histograms"]
+    counts = detector.run_metrics["counts"]
+
+    row_count = counts.get("postgres_rows", 0) + counts.get("postgres_state_updates", 0)
+    write_seconds = histograms["postgres_write_seconds"]["sum"] if "postgres_write_seconds" in histograms else 0.0
+
+    result = dict()
+    result["image_count"] = image_count
+    result["image_fail_count"] = image_fail_count
+    result["label_count"] = label_count
+    result["seconds"] = seconds
+    result["images_per_second"] = image_count / seconds
+    result["db_rows_per_second"] = row_count / max(write_seconds, 0.001)
+    result["wms_retries"] = counts.get("wms_retries", 0)
+
+    for name in ["download_seconds", "image_wait_seconds", "decode_seconds", "inference_seconds",
+                 "postgres_write_seconds"]:
+        if name in histograms:
+            result[f"{name}_p50"] = detector.get_histogram_percentile(histograms[name], 50)
+            result[f"{name}_p99"] = detector.get_histogram_percentile(histograms[name], 99)
+
+    print(f"\t - {image_count} images : {seconds:.1f}s : {result['images_per_second']:.1f} images/sec : "
+          f"download p50 {result.get('download_seconds_p50', 0.0):.3f}s p99 "
+          f"{result.get('download_seconds_p99', 0.0):.3f}s : "
+          f"inference p50 {result.get('inference_seconds_p50', 0.0):.4f}s p99 "
+          f"{result.get('inference_seconds_p99', 0.0):.4f}s : {result['db_rows_per_second']:.0f} DB rows/sec : "
+          f"{image_fail_count} failed : {result['wms_retries']} retries")
+
+    return result
+
+
+def clear_tables():
+    pg_conn = psycopg2.connect(pg_connect_string)
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor()
+
+    for table_name in [detector.label_table, detector.image_table, detector.tile_table]:
+        pg_cur.execute(f"truncate table {table_name}")
+
+    pg_cur.close()
+    pg_conn.close()
+
+
+def set_grid_bounds(grid_image_count):
+    """Sets the min/max coords of the grid to get a square(ish) grid of at least the given number of images"""
+
+    column_count = math.ceil(math.sqrt(grid_image_count))
+    row_count = math.ceil(grid_image_count / column_count)
+
+    # stop half an image short of the last column & row, so rounding can't add another one
+    detector.input_x_min = 151.0
+    detector.input_y_max = -33.8
+    detector.input_x_max = detector.input_x_min + (column_count - 0.5) * detector.x_stride
+    detector.input_y_min = detector.input_y_max - (row_count - 0.5) * detector.y_stride
+
+
+def run_fake_wms(wms_ready):
+    """Runs the fake WMS until the process is stopped"""
+
+    app = aiohttp.web.Application()
+    app["images"] = dict()
+    app.router.add_get("/wms", handle_wms_request)
+
+    async def start_server():
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await aiohttp.web.TCPSite(runner, wms_host, wms_port).start()
+        wms_ready.set()
+
+        while True:
+            await asyncio.sleep(3600)
+
+    asyncio.run(start_server())
+
+
+async def handle_wms_request(request):
+    """Responds to a WMS GetMap request with a JPEG of the requested size; after a random delay, or with an error"""
+
+    await asyncio.sleep(random.expovariate(1.0 / wms_delay_seconds))
+
+    if random.random() < wms_error_rate:
+        raise aiohttp.web.HTTPServiceUnavailable()
+
+    image_size = (int(request.query["width"]), int(request.query["height"]))
+
+    # cut the images for each image size once
+    if image_size not in request.app["images"]:
+        request.app["images"][image_size] = make_wms_images(image_size)
+
+    return aiohttp.web.Response(body=random.choice(request.app["images"][image_size]), content_type="image/jpeg")
+
+
+def make_wms_images(image_size):
+    """Cuts JPEGs of the given size from the sample images (scaling the sample images up if they're too small)"""
+
+    sample_images = [Image.open(os.path.join(os.path.dirname(script_dir), "sample-images", file_name)).convert("RGB")
+                     for file_name in ["sample.png", "sample2.png"]]
+
+    image_list = list()
+
+    for i in range(wms_image_count):
+        sample_image = sample_images[i % len(sample_images)]
+
+        scale = max(image_size[0] / sample_image.width, image_size[1] / sample_image.height, 1.0)
+        if scale > 1.0:
+            sample_image = sample_image.resize((math.ceil(sample_image.width * scale),
+                                                math.ceil(sample_image.height * scale)))
+
+        # step the images across & down the sample image
+        left = (i * 97) % (sample_image.width - image_size[0] + 1)
+        top = (i * 61) % (sample_image.height - image_size[1] + 1)
+
+        image_file = io.BytesIO()
+        sample_image.crop((left, top, left + image_size[0], top + image_size[1])).save(image_file, format="JPEG")
+        image_list.append(image_file.getvalue())
+
+    return image_list
+
+
+def load_stub_model(device):
+    return None
+
+
+def detect_pools_with_stub_model(model, device, image_list):
+    """Stands in for the model: decodes the batch of images the way the real pipeline does, then returns a random label
+       for some of the images (so labels are written to Postgres too)"""
+
+    decode_start_time = time.perf_counter()
+    detector.get_image_batch_tensor(image_list, device)
+    detector.record_timing("decode_seconds", time.perf_counter() - decode_start_time)
+
+    inference_start_time = time.perf_counter()
+    tensor_labels = list()
+
+    for _ in image_list:
+        if random.random() < stub_pool_image_share:
+            left = random.uniform(0.0, detector.image_width - 40.0)
+            top = random.uniform(0.0, detector.image_height - 40.0)
+            tensor_labels.append(torch.tensor([[left, top, left + 30.0, top + 30.0, 0.9, 0.0]], device=device))
+        else:
+            tensor_labels.append(torch.zeros((0, 6), device=device))
+
+    detector.record_timing("inference_seconds", time.perf_counter() - inference_start_time)
+
+    return tensor_labels
+
+
+def compare_with_last_results(results):
+    """Shows how much faster or slower each grid is than the last benchmark; flagging big drops as regressions"""
+
+    if not os.path.isfile(results_path):
+        return
+
+    with open(results_path, "r") as results_file:
+        last_results = {last_result["image_count"]: last_result for last_result in json.load(results_file)}
+
+    for result in results:
+        last_result = last_results.get(result["image_count"])
+        if last_result is None:
+            continue
+
+        change = result["images_per_second"] / last_result["images_per_second"] - 1.0
+        regression = " : REGRESSION" if change < -regression_threshold else ""
+
+        print(f"\t - {result['image_count']} images : {change:+.1%} images/sec vs. last benchmark{regression}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""-----------------------------------------------------------------------------------------------------------------
+ Compares the accuracy & speed of the inference backends & precisions in 06_detect_pools.py (e.g. PyTorch vs.
+ ONNX Runtime with int8 weights) on the labelled training images.
+
+ Accuracy is the precision & recall of each backend's labels vs. the training labels (a label is found if a detected
+ label overlaps it by the IoU threshold); and the share of the PyTorch model's labels each backend also finds.
+ Uses the training images & labels loaded into Postgres by 04_load_training_data_to_postgres.py; and the models
+ exported by 05a_export_model.py
+
+ License: Apache v2
+-----------------------------------------------------------------------------------------------------------------"""
+
+import importlib
+import logging
+import numpy
+import os
+import psycopg2
+import rasterio
+import rasterio.enums
+import sys
+import time
+import torch
+import torchvision.ops
+
+# the directory of this script, the pool detection script & the training data loading script
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(script_dir))
+detector = importlib.import_module("06_detect_pools")
+loader = importlib.import_module("04_load_training_data_to_postgres")
+
+# backends & precisions to compare (the first one is the baseline). fp16 is only tested on GPUs & int8 on CPUs
+backends = [["pytorch", "fp32"], ["torchscript", "fp32"], ["onnx", "fp32"], ["onnx", "int8"],
+            ["pytorch", "fp16"], ["torchscript", "fp16"]]
+
+# max number of training images to test (None = all)
+image_limit = 1000
+
+# number of images per batch
+batch_size = 32
+
+# min overlap (intersection over union) of a detected label & a training label for the pool to be found
+iou_threshold = 0.5
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    detector.logger = logging.getLogger()
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    image_list, training_boxes = get_training_images()
+    training_label_count = sum([len(boxes) for boxes in training_boxes])
+
+    print(f"Comparing inference backends on {device} : {len(image_list)} training images : "
+          f"{training_label_count} labels")
+
+    baseline = None
+
+    for backend, precision in backends:
+        if (precision == "fp16" and device.type != "cuda") or (precision == "int8" and device.type != "cpu"):
+            continue
+
+        detector.inference_backend = backend
+        detector.inference_precision = precision
+
+        try:
+            model = detector.load_model(device)
+        except Exception as ex:
+            print(f"\t - {backend} {precision} : SKIPPED : {ex}")
+            continue
+
+        seconds, detected_boxes = run_model(model, device, image_list)
+
+        precision_rate, recall = get_precision_and_recall(detected_boxes, training_boxes)
+
+        if baseline is None:
+            baseline = {"seconds": seconds, "boxes": detected_boxes}
+
+        # the share of the baseline's labels this backend also finds
+        _, baseline_recall = get_precision_and_recall(detected_boxes, baseline["boxes"])
+
+        print(f"\t - {backend} {precision} : {len(image_list) / seconds:.1f} images/sec "
+              f"({baseline['seconds'] / seconds:.2f}x) : precision {precision_rate:.1%} : recall {recall:.1%} : "
+              f"{baseline_recall:.1%} of baseline labels found")
+
+
+def get_training_images():
+    """Gets the training images as (3, height, width) uint8 arrays & their labels as pixel bounding boxes"""
+
+    pg_conn = psycopg2.connect(loader.pg_connect_string)
+    pg_cur = pg_conn.cursor()
+
+    sql = f"""select file_path, st_xmin(geom), st_ymax(geom), width, height
+              from {loader.image_table}
+              order by random()"""
+    if image_limit is not None:
+        sql += f" limit {image_limit}"
+
+    pg_cur.execute(sql)
+    image_rows = [row for row in pg_cur.fetchall() if os.path.isfile(row[0])]
+
+    pg_cur.execute(f"""select file_path, st_xmin(geom), st_ymin(geom), st_xmax(geom), st_ymax(geom)
+                       from {loader.label_table}
+                       where file_path = any(%s)""", ([row[0] for row in image_rows],))
+
+    label_rows = dict()
+    for row in pg_cur.fetchall():
+        label_rows.setdefault(row[0], list()).append(row[1:])
+
+    pg_cur.close()
+    pg_conn.close()
+
+    image_list = list()
+    training_boxes = list()
+
+    for file_path, x_min, y_max, width, height in image_rows:
+        # read the image at the size the model is run at
+        with rasterio.open(file_path) as image:
+            image_list.append(image.read([1, 2, 3], out_shape=(3, detector.image_height, detector.image_width),
+                                         resampling=rasterio.enums.Resampling.bilinear))
+
+        # convert the labels' lat/long bounds to pixels
+        boxes = [[(label_x_min - x_min) / width * detector.image_width,
+                  (y_max - label_y_max) / height * detector.image_height,
+                  (label_x_max - x_min) / width * detector.image_width,
+                  (y_max - label_y_min) / height * detector.image_height]
+                 for label_x_min, label_y_min, label_x_max, label_y_max in label_rows.get(file_path, list())]
+        training_boxes.append(torch.tensor(boxes, dtype=torch.float32).reshape(-1, 4))
+
+    return image_list, training_boxes
+
+
+def run_model(model, device, image_list):
+    """Runs the model on all images in batches. Returns the run time (after a warm up run) & each image's label boxes"""
+
+    detector.detect_pools(model, device, image_list[:batch_size])
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    start_time = time.perf_counter()
+    detected_boxes = list()
+
+    for first_image in range(0, len(image_list), batch_size):
+        tensor_labels = detector.detect_pools(model, device, image_list[first_image:first_image + batch_size])
+        detected_boxes.extend([tensor_label[:, :4].float().cpu() for tensor_label in tensor_labels])
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    return time.perf_counter() - start_time, detected_boxes
+
+
+def get_precision_and_recall(detected_boxes, expected_boxes):
+    """Gets the share of detected labels that match an expected label (precision) & the share of expected labels that
+       match a detected label (recall). Each label can only match one other label"""
+
+    matched_count = 0
+    detected_count = 0
+    expected_count = 0
+
+    for detected, expected in zip(detected_boxes, expected_boxes):
+        detected_count += len(detected)
+        expected_count += len(expected)
+
+        if len(detected) == 0 or len(expected) == 0:
+            continue
+
+        # match the most overlapping pairs first
+        ious = torchvision.ops.box_iou(detected, expected).numpy()
+
+        while True:
+            best_index = numpy.unravel_index(numpy.argmax(ious), ious.shape)
+            if ious[best_index] < iou_threshold:
+                break
+
+            matched_count += 1
+            ious[best_index[0], :] = 0.0
+            ious[:, best_index[1]] = 0.0
+
+    return matched_count / max(detected_count, 1), matched_count / max(expected_count, 1)
+
+
+if __name__ == "__main__":
+    main()
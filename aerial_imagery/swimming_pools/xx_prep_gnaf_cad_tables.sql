@@ -37,6 +37,7 @@ ALTER TABLE data_science.address_principals_nsw CLUSTER ON address_principals_ns
 
 
 -- create a grid of tiles to detect pools in covering all of Sydney
+-- note: not needed if 06_detect_pools.py creates the grid itself - export the boundary & set clip_boundary_path instead
 drop table if exists data_science.sydney_grid;
 create table data_science.sydney_grid as
 WITH grid AS (